@@ -0,0 +1,276 @@
+'''
+AMQP-consumer wrapper for asyncio.
+
+One connection & channel per AsyncConsumer, any number of subscriptions on
+the same event loop. Messages are delivered straight from the loop (no
+extra thread, no polling), either to a callback or via async iteration.
+Publishing shares the same connection.
+
+Dropped connection is reopened with exponential backoff and jitter,
+declared exchanges & subscriptions are redeclared, messages published
+while disconnected are sent after reconnect (in order).
+
+With confirm=True the channel is in publisher confirms mode and publish()
+returns a future resolved with True (ack) or False (nack, or lost with the
+connection or on close), publishing itself never waits for the broker.
+
+    consumer = AsyncConsumer(host)
+    await consumer.connect()
+    sub = await consumer.subscribe('topic', 'chat')
+    consumer.publish('chat', '', b'hello')
+    async for msg in sub:
+        ...
+    await consumer.close()
+'''
+
+import asyncio
+import random
+from collections import deque
+import pika
+from pika.adapters.asyncio_connection import AsyncioConnection
+
+######################################################
+## RabbitMQ consumer (AMQP, asyncio)
+
+class Subscription:
+    '''exclusive anonymous queue bound to exchange, survives reconnects'''
+
+    _STOP = object() # end-of-stream marker
+
+    def __init__(self, consumer, exchange_type, exchange_name, routing_key, callback=None):
+        self.consumer = consumer
+        self.exchange_type = exchange_type
+        self.exchange_name = exchange_name
+        self.routing_key = routing_key
+        self.callback = callback
+        self.queue_name = None # of current connection
+        self.consumer_tag = None
+        self._inbox = asyncio.Queue()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        msg = await self._inbox.get()
+        if msg is self._STOP:
+            raise StopAsyncIteration
+        return msg
+
+    def cancel(self):
+        '''stop consuming, wake up the iterating task'''
+        self.consumer._cancel(self)
+        self._inbox.put_nowait(self._STOP)
+
+    def _on_message(self, channel, method, properties, body):
+        if not body:
+            return
+        msg = body.decode("utf8")
+        if self.callback:
+            try:
+                self.callback(msg)
+            except Exception as e:
+                print(' [!] Error in %s subscription callback: %r' % (self.exchange_name, e))
+        else:
+            self._inbox.put_nowait(msg)
+
+
+class AsyncConsumer:
+    RECONNECT_MIN = 0.5 # sec, first retry delay
+    RECONNECT_MAX = 30 # sec, retry delay limit
+
+    def __init__(self, host, loop=None, confirm=False):
+        '''init consumer'''
+        self.host = host
+        self.loop = loop
+        self.confirm = confirm
+        self.connection = None
+        self.channel = None
+        self.subscriptions = []
+        self.exchanges = {} # name -> type, redeclared after reconnect
+        self._outbox = deque() # (exchange, routing_key, body, properties, future or None)
+        self._unconfirmed = {} # delivery_tag -> future, in publish order (confirm mode)
+        self._next_tag = 1 # delivery tag of the next publish on current channel
+        self._pending = set() # futures of async calls in progress
+        self._ready = False # topology is restored on current channel
+        self._attempt = 0
+        self._closing = False
+        self._opened = None
+        self._closed = None
+
+    async def connect(self):
+        '''open connection & channel, retries until connected'''
+        self.loop = self.loop or asyncio.get_running_loop()
+        self._opened = self.loop.create_future()
+        self._closed = self.loop.create_future()
+        self._open()
+        await self._opened
+
+    async def subscribe(self, exchange_type, exchange_name, routing_key='', callback=None):
+        '''declare exchange, bind exclusive queue & start consuming
+        Returns Subscription (async iterator unless callback is given).
+        '''
+        sub = Subscription(self, exchange_type, exchange_name, routing_key, callback)
+        self.subscriptions.append(sub)
+        if self._ready:
+            try:
+                await self._start_subscription(sub)
+            except ConnectionError:
+                pass # started again after reconnect
+        return sub
+
+    def declare_exchange(self, exchange_type, exchange_name):
+        self.exchanges[exchange_name] = exchange_type
+        if self._ready:
+            self.channel.exchange_declare(exchange=exchange_name, exchange_type=exchange_type)
+
+    def publish(self, exchange_name, routing_key, body, properties=None):
+        '''send message, it is queued while disconnected
+        In confirm mode returns future of the broker confirmation.
+        '''
+        body = body if isinstance(body, bytes) else bytes(body, "utf8")
+        future = self.loop.create_future() if self.confirm else None
+        if self._closing and not self._ready:
+            if future is not None:
+                future.set_result(False) # closed, never sent
+            return future
+        self._outbox.append((exchange_name, routing_key, body, properties, future))
+        self._flush_outbox()
+        return future
+
+    async def close(self):
+        '''cancel all subscriptions & close connection immediately'''
+        self._closing = True
+        self._flush_outbox() # last words
+        for sub in list(self.subscriptions):
+            sub.cancel()
+        if self.connection and not (self.connection.is_closing or self.connection.is_closed):
+            self.connection.close()
+            await self._closed
+        self._resolve_unconfirmed()
+        for *_, future in self._outbox:
+            if future and not future.done():
+                future.set_result(False) # never sent
+        self._outbox.clear()
+
+    def _open(self):
+        if self._closing:
+            return
+        self.connection = AsyncioConnection(
+            pika.ConnectionParameters(host=self.host),
+            on_open_callback=self._on_connection_open,
+            on_open_error_callback=self._on_connection_closed,
+            on_close_callback=self._on_connection_closed,
+            custom_ioloop=self.loop)
+
+    def _on_connection_open(self, connection):
+        connection.channel(on_open_callback=self._on_channel_open)
+
+    def _on_channel_open(self, channel):
+        self.channel = channel
+        channel.add_on_close_callback(self._on_channel_closed)
+        self.loop.create_task(self._restore())
+
+    async def _restore(self):
+        '''redeclare topology & send what is queued'''
+        try:
+            if self.confirm:
+                await self._call(self.channel.confirm_delivery, self._on_confirm)
+                self._next_tag = 1
+            for exchange_name, exchange_type in list(self.exchanges.items()):
+                await self._call(self.channel.exchange_declare, exchange=exchange_name, exchange_type=exchange_type)
+            for sub in list(self.subscriptions):
+                await self._start_subscription(sub)
+        except ConnectionError:
+            return # lost again, restored after next reconnect
+        self._attempt = 0
+        self._ready = True
+        self._flush_outbox()
+        if not self._opened.done():
+            self._opened.set_result(True)
+
+    async def _start_subscription(self, sub):
+        channel = self.channel
+        await self._call(channel.exchange_declare, exchange=sub.exchange_name, exchange_type=sub.exchange_type)
+        frame = await self._call(channel.queue_declare, '', exclusive=True)
+        await self._call(channel.queue_bind, frame.method.queue, sub.exchange_name, routing_key=sub.routing_key)
+        if sub in self.subscriptions: # not cancelled meanwhile
+            sub.queue_name = frame.method.queue
+            sub.consumer_tag = channel.basic_consume(sub.queue_name, sub._on_message, auto_ack=True, exclusive=True)
+
+    def _flush_outbox(self):
+        while self._outbox and self._ready:
+            exchange_name, routing_key, body, properties, future = self._outbox[0]
+            try:
+                self.channel.basic_publish(exchange_name, routing_key, body, properties)
+            except pika.exceptions.AMQPError:
+                return # kept in order, resent after reconnect
+            self._outbox.popleft()
+            if future is not None:
+                self._unconfirmed[self._next_tag] = future
+            self._next_tag += 1
+
+    def _on_confirm(self, frame):
+        '''Basic.Ack / Basic.Nack handler (confirm mode)'''
+        method = frame.method
+        acked = isinstance(method, pika.spec.Basic.Ack)
+        if method.multiple:
+            tags = [tag for tag in self._unconfirmed if tag <= method.delivery_tag]
+        else:
+            tags = [method.delivery_tag]
+        for tag in tags:
+            future = self._unconfirmed.pop(tag, None)
+            if future is not None and not future.done():
+                future.set_result(acked)
+
+    def _resolve_unconfirmed(self):
+        '''messages in flight on a closed channel are lost (or at least not confirmed)'''
+        for future in self._unconfirmed.values():
+            if not future.done():
+                future.set_result(False)
+        self._unconfirmed.clear()
+
+    def _cancel(self, sub):
+        if sub in self.subscriptions:
+            self.subscriptions.remove(sub)
+            if self._ready and sub.consumer_tag:
+                self.channel.basic_cancel(sub.consumer_tag)
+
+    def _on_channel_closed(self, channel, reason):
+        # closed by broker (e.g. declare error) - reopen everything
+        if self.connection.is_open:
+            self.connection.close()
+
+    def _on_connection_closed(self, connection, reason):
+        self.channel = None
+        self._ready = False
+        for future in self._pending:
+            if not future.done():
+                future.set_exception(ConnectionError(reason))
+        self._pending.clear()
+        self._resolve_unconfirmed()
+
+        if self._closing:
+            for sub in list(self.subscriptions):
+                sub._inbox.put_nowait(Subscription._STOP)
+            self.subscriptions.clear()
+            if not self._closed.done():
+                self._closed.set_result(reason)
+            return
+
+        delay = min(self.RECONNECT_MAX, self.RECONNECT_MIN * 2 ** self._attempt) * random.uniform(0.5, 1.0)
+        self._attempt += 1
+        print(' [!] AMQP connection to %s lost (%r), reconnect in %.1f s' % (self.host, reason, delay))
+        self.loop.call_later(delay, self._open)
+
+    def _call(self, method, *args, **kwargs):
+        '''call pika async method, return awaitable of its completion frame'''
+        done = self.loop.create_future()
+        self._pending.add(done)
+
+        def on_done(frame):
+            self._pending.discard(done)
+            if not done.done():
+                done.set_result(frame)
+
+        method(*args, callback=on_done, **kwargs)
+        return done
@@ -0,0 +1,80 @@
+'''
+Message codecs selected by AMQP content_type property.
+
+    codec = get_codec(properties.content_type)
+    msg = codec.decode(body)
+
+Messages without content_type are decoded as JSON (old emulators).
+'''
+
+import json
+import struct
+
+######################################################
+## codecs
+
+class JsonCodec:
+    CONTENT_TYPE = 'application/json'
+
+    def encode(self, msg):
+        return bytes(json.dumps(msg), "utf8")
+
+    def decode(self, body):
+        return json.loads(body.decode("utf8"))
+
+
+class MeterReadingCodec:
+    '''
+    Fixed layout meter reading: {'id','ts','value','state'} packed as
+    id uint32, ts float64, value float64, state uint8 (21 bytes, network order).
+    Meter id travels as number and is decoded back into str, so only ids
+    which are plain uint32 numbers fit (see fits_id), others go as JSON.
+    '''
+    CONTENT_TYPE = 'application/x-meter-reading'
+    LAYOUT = struct.Struct('!IddB')
+
+    @staticmethod
+    def fits_id(meter_id):
+        '''meter id survives binary round trip'''
+        meter_id = str(meter_id)
+        return meter_id.isdigit() and str(int(meter_id)) == meter_id and int(meter_id) < 2 ** 32
+
+    def encode(self, msg):
+        if not self.fits_id(msg['id']):
+            raise ValueError('meter id %r does not fit binary reading, use JSON codec' % (msg['id'],))
+        return self.LAYOUT.pack(int(msg['id']), msg['ts'], msg['value'], msg['state'])
+
+    def decode(self, body):
+        if len(body) != self.LAYOUT.size:
+            raise ValueError('bad meter reading size: %d' % len(body))
+        meter_id, ts, value, state = self.LAYOUT.unpack(body)
+        return {'id': str(meter_id), 'ts': ts, 'value': value, 'state': state}
+
+
+######################################################
+## registry
+
+DEFAULT_CODEC = JsonCodec()
+
+CODECS = {
+    DEFAULT_CODEC.CONTENT_TYPE: DEFAULT_CODEC,
+    MeterReadingCodec.CONTENT_TYPE: MeterReadingCodec(),
+}
+
+def register_codec(codec):
+    '''add (or replace) codec for its CONTENT_TYPE'''
+    CODECS[codec.CONTENT_TYPE] = codec
+
+def get_codec(content_type=None):
+    '''codec for content_type, JSON if not specified
+    Raises ValueError for unknown content_type.
+    '''
+    if not content_type:
+        return DEFAULT_CODEC
+    try:
+        return CODECS[content_type]
+    except KeyError:
+        raise ValueError('unsupported content_type: %s' % content_type)
+
+def decode(body, content_type=None):
+    return get_codec(content_type).decode(body)
@@ -1,53 +1,56 @@
 '''
 AMQP-consumer wrapper with dedicated thread.
+
+Transport is selected by host (see amqp.transport), 'inproc' consumes
+from in-process broker and puts published objects into msg_queue as is.
 '''
 
 import threading
 import queue
-import pika
+from amqp.transport import get_transport
 
 ######################################################
 ## RabbitMQ producer (AMQP)
 
 class ConsumerThread(threading.Thread):
-    def __init__(self, msg_queue, host, exchange_type, exchange_name, routing_key=''):
+    def __init__(self, msg_queue, host, exchange_type, exchange_name, routing_key='', transport=None):
         '''init consumer thread'''
         super(ConsumerThread, self).__init__()
         self._is_interrupted = False
+        self._subscription = None
+        self.ready = threading.Event() # set when the queue is bound, messages published since are delivered
         self.msg_queue = msg_queue
         self.host = host
         self.exchange_type = exchange_type
         self.exchange_name = exchange_name
         self.routing_key = routing_key
+        self.transport = transport or get_transport(host)
 
     def stop(self):
         '''set stop-flag'''
         self._is_interrupted = True
+        if self._subscription:
+            self._subscription.wakeup()
 
     def run(self):
         '''thread proc'''
-        connection = pika.BlockingConnection(pika.ConnectionParameters(host=self.host))
-        channel = connection.channel()
-        channel.exchange_declare(exchange=self.exchange_name, exchange_type=self.exchange_type)
-        result = channel.queue_declare('', exclusive=True)
-        queue_name = result.method.queue
-        channel.queue_bind(exchange=self.exchange_name, routing_key=self.routing_key, queue=queue_name)
-
-        for message in channel.consume(queue_name, auto_ack=True, exclusive=True, inactivity_timeout=1):
+        self._subscription = self.transport.subscribe(self.exchange_type, self.exchange_name, self.routing_key)
+        self.ready.set()
+
+        for message in self._subscription.consume(inactivity_timeout=1):
             if self._is_interrupted:
                 break
             if not message:
                 continue
 
-            #method, properties, body = message
-            #print(method, properties, body)
+            #body, properties = message
+            #print(properties, body)
 
-            _, _, body = message
+            body, _ = message
             if not body:
                 continue
 
-            msg = body.decode("utf8")
+            msg = body.decode("utf8") if isinstance(body, bytes) else body
             self.msg_queue.put(msg)
         
-        channel.cancel() # cancel consuimng
-        connection.close()
+        self._subscription.close()
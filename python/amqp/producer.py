@@ -1,34 +1,59 @@
 '''
 AMQP-producer wrapper.
+
+In confirm mode (Producer(..., confirm=True)) publishing is pipelined:
+messages are written without waiting for the broker, up to `window`
+unconfirmed messages are kept in flight, and each publish returns a
+concurrent.futures.Future resolved with True (ack) or False (nack/lost).
+
+Transport is selected by host (see amqp.transport), 'inproc' publishes
+to in-process broker.
 '''
 
-import pika
+from amqp.transport import get_transport
 
 ######################################################
 ## RabbitMQ producer (AMQP)
 
 class Producer:
-    def __init__(self, host, exchange_type, exchange_name):
+    DEFAULT_WINDOW = 256 # max unconfirmed messages in flight
+
+    def __init__(self, host, exchange_type, exchange_name, confirm=False, window=DEFAULT_WINDOW, transport=None):
         '''init producer'''
         self.host = host
         self.exchange_name = exchange_name
         self.exchange_type = exchange_type
+        self.confirm = confirm
+        self.window = window
+        self.transport = transport or get_transport(host)
         self.open()
 
-    def publish(self, msg, routing_key=''):
-        '''publish message with routing_key'''
-        bmsg = bytes(msg, "utf8")
-        self.channel.basic_publish(exchange=self.exchange_name, routing_key=routing_key, body=bmsg)
+    def publish(self, msg, routing_key='', properties=None):
+        '''publish message with routing_key
+        In confirm mode returns Future of the broker confirmation.
+        '''
+        return self.publisher.publish(msg, routing_key, properties)
+
+    def publish_many(self, msgs, properties=None):
+        '''publish sequence of (msg, routing_key) with one output flush
+        In confirm mode returns list of Futures (one per message).
+        '''
+        return self.publisher.publish_many(msgs, properties)
+
+    def wait_for_confirms(self, timeout=None):
+        '''wait until all in-flight messages are confirmed
+        Returns True if nothing left unconfirmed.
+        '''
+        return self.publisher.wait_for_confirms(timeout)
 
     def open(self):
         '''(re-)open connection'''
-        self.connection = pika.BlockingConnection(pika.ConnectionParameters(host=self.host))
-        self.channel = self.connection.channel()
-        self.channel.exchange_declare(exchange=self.exchange_name, exchange_type=self.exchange_type)
+        self.publisher = self.transport.publisher(self.exchange_type, self.exchange_name,
+            confirm=self.confirm, window=self.window)
     
     def close(self):
         '''cleanup connection'''
-        self.connection.close()
+        self.publisher.close()
 
     def process_data_events(self):
-        self.connection.process_data_events()
+        self.publisher.process_data_events()
@@ -0,0 +1,419 @@
+'''
+Transports behind Producer & ConsumerThread.
+
+Besides exclusive subscriptions, work_queue() consumes a named queue shared
+by competing workers with manual ack/nack (e.g. meters_srv).
+
+PikaTransport   - RabbitMQ: subscriptions & work queues via
+                  pika.BlockingConnection, publishers via AsyncConsumer
+                  on own IO thread (auto-reconnect, pipelined confirms).
+InprocTransport - in-process broker for co-located components & broker-free
+                  tests: does fanout/direct/topic ('*', '#') routing itself
+                  and hands published objects to consumers as is
+                  (no copy, no serialization).
+
+get_transport(host) selects by host: 'inproc' (or 'inproc://<name>')
+gives in-process transport, anything else is a broker host.
+'''
+
+import asyncio
+import threading
+import queue
+from concurrent.futures import Future, wait
+
+INPROC_SCHEME = 'inproc'
+
+def get_transport(host):
+    '''transport for host string'''
+    if host == INPROC_SCHEME or host.startswith(INPROC_SCHEME + '://'):
+        return InprocTransport(host)
+    return PikaTransport(host)
+
+def _resolved(result):
+    future = Future()
+    future.set_result(result)
+    return future
+
+######################################################
+## pika backend
+
+class PikaTransport:
+    def __init__(self, host):
+        self.host = host
+
+    def publisher(self, exchange_type, exchange_name, confirm=False, window=256):
+        return PikaPublisher(self.host, exchange_type, exchange_name, confirm, window)
+
+    def subscribe(self, exchange_type, exchange_name, routing_key=''):
+        return PikaSubscription(self.host, exchange_type, exchange_name, routing_key)
+
+    def work_queue(self, exchange_type, exchange_name, queue_name, routing_key='', prefetch=1):
+        return PikaWorkQueue(self.host, exchange_type, exchange_name, queue_name, routing_key, prefetch)
+
+    def close(self):
+        pass # publishers & subscriptions close their own connections
+
+
+class PikaPublisher:
+    '''
+    Publishes through AsyncConsumer running on its own IO thread, so the
+    connection is served (heartbeats, confirms) between publishes and a
+    dropped one is reopened, messages published meanwhile are sent after
+    reconnect.
+    In confirm mode publishing is pipelined: messages are written without
+    waiting for the broker, up to `window` unconfirmed messages are kept
+    in flight, each publish returns Future resolved with True (ack)
+    or False (nack, lost with the connection or on close).
+    '''
+
+    def __init__(self, host, exchange_type, exchange_name, confirm, window):
+        from amqp.async_consumer import AsyncConsumer
+        self.exchange_name = exchange_name
+        self.confirm = confirm
+        self._window = threading.Semaphore(max(1, window))
+        self._lock = threading.Lock()
+        self._unconfirmed = set() # Futures not resolved yet
+
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self._thread.start()
+        self.amqp = AsyncConsumer(host, loop=self.loop, confirm=confirm)
+        self._run(self.amqp.connect())
+        self.loop.call_soon_threadsafe(self.amqp.declare_exchange, exchange_type, exchange_name)
+
+    def publish(self, body, routing_key, properties):
+        future = None
+        if self.confirm:
+            self._window.acquire()
+            future = self._track()
+        self._hand_over([(body, routing_key, future)], properties)
+        return future
+
+    def publish_many(self, msgs, properties):
+        futures = []
+        batch = []
+        for body, routing_key in msgs:
+            future = None
+            if self.confirm:
+                if not self._window.acquire(blocking=False):
+                    self._hand_over(batch, properties) # send what is ready while waiting for confirms
+                    batch = []
+                    self._window.acquire()
+                future = self._track()
+                futures.append(future)
+            batch.append((body, routing_key, future))
+        self._hand_over(batch, properties)
+        return futures if self.confirm else None
+
+    def wait_for_confirms(self, timeout=None):
+        with self._lock:
+            pending = list(self._unconfirmed)
+        wait(pending, timeout)
+        with self._lock:
+            return not self._unconfirmed
+
+    def process_data_events(self):
+        pass # served by IO thread
+
+    def close(self):
+        if self.confirm:
+            self.wait_for_confirms(timeout=5)
+        self._run(self.amqp.close()) # whatever is left is resolved as lost
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.loop.close()
+
+    def _run(self, coro):
+        '''run coroutine on IO thread, wait for its result'''
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def _track(self):
+        future = Future()
+        future.set_running_or_notify_cancel()
+        with self._lock:
+            self._unconfirmed.add(future)
+        return future
+
+    def _hand_over(self, batch, properties):
+        '''one IO thread wakeup per batch'''
+        if batch:
+            self.loop.call_soon_threadsafe(self._publish, batch, properties)
+
+    def _publish(self, batch, properties):
+        '''(IO thread) write messages, resolve their Futures on confirms'''
+        for body, routing_key, future in batch:
+            confirmed = self.amqp.publish(self.exchange_name, routing_key, body, properties)
+            if future is not None:
+                confirmed.add_done_callback(lambda c, future=future: self._settle(future, c.result()))
+
+    def _settle(self, future, result):
+        with self._lock:
+            self._unconfirmed.discard(future)
+        self._window.release()
+        future.set_result(result)
+
+
+class PikaSubscription:
+    '''exclusive anonymous queue bound to exchange'''
+
+    def __init__(self, host, exchange_type, exchange_name, routing_key):
+        import pika
+        self.connection = pika.BlockingConnection(pika.ConnectionParameters(host=host))
+        self.channel = self.connection.channel()
+        self.channel.exchange_declare(exchange=exchange_name, exchange_type=exchange_type)
+        result = self.channel.queue_declare('', exclusive=True)
+        self.queue_name = result.method.queue
+        self.channel.queue_bind(exchange=exchange_name, routing_key=routing_key, queue=self.queue_name)
+
+    def consume(self, inactivity_timeout=1):
+        '''yields (body, properties), None on inactivity timeout'''
+        for message in self.channel.consume(self.queue_name, auto_ack=True, exclusive=True,
+                inactivity_timeout=inactivity_timeout):
+            if not message or not message[2]:
+                yield None
+                continue
+            _, properties, body = message
+            yield body, properties
+
+    def wakeup(self):
+        '''(thread-safe) nothing to do, consume() wakes up by inactivity timeout'''
+        pass
+
+    def close(self):
+        self.channel.cancel() # cancel consuimng
+        self.connection.close()
+
+class PikaWorkQueue:
+    '''durable named queue bound to exchange, shared by workers, manual acks'''
+
+    def __init__(self, host, exchange_type, exchange_name, queue_name, routing_key, prefetch):
+        import pika
+        self.queue_name = queue_name
+        self.connection = pika.BlockingConnection(pika.ConnectionParameters(host=host))
+        self.channel = self.connection.channel()
+        self.channel.exchange_declare(exchange=exchange_name, exchange_type=exchange_type)
+        self.channel.queue_declare(queue_name, durable=True)
+        self.channel.queue_bind(exchange=exchange_name, queue=queue_name, routing_key=routing_key)
+        self.channel.basic_qos(prefetch_count=prefetch)
+
+    def consume(self, inactivity_timeout=1):
+        '''yields (body, properties, delivery_tag), None on inactivity timeout'''
+        for message in self.channel.consume(self.queue_name, inactivity_timeout=inactivity_timeout):
+            if not message or not message[0]:
+                yield None
+                continue
+            method, properties, body = message
+            yield body, properties, method.delivery_tag
+
+    def ack(self, delivery_tag, multiple=False):
+        self.channel.basic_ack(delivery_tag=delivery_tag, multiple=multiple)
+
+    def nack(self, delivery_tag, multiple=False, requeue=True):
+        self.channel.basic_nack(delivery_tag=delivery_tag, multiple=multiple, requeue=requeue)
+
+    def wakeup(self):
+        '''(thread-safe) nothing to do, consume() wakes up by inactivity timeout'''
+        pass
+
+    def close(self):
+        self.channel.cancel() # cancel consuming, not acked messages are requeued
+        self.connection.close()
+
+######################################################
+## in-process backend
+
+def topic_matches(pattern, routing_key):
+    '''AMQP topic match: '*' is exactly one word, '#' is zero or more words'''
+    p = pattern.split('.')
+    k = routing_key.split('.')
+
+    def match(i, j):
+        if i == len(p):
+            return j == len(k)
+        if p[i] == '#':
+            return any(match(i + 1, jj) for jj in range(j, len(k) + 1))
+        if j == len(k):
+            return False
+        return (p[i] == '*' or p[i] == k[j]) and match(i + 1, j + 1)
+
+    return match(0, 0)
+
+
+class InprocBroker:
+    '''process-wide exchanges & queues, one broker per inproc host name'''
+
+    _brokers = {}
+    _brokers_lock = threading.Lock()
+
+    @classmethod
+    def instance(cls, name):
+        with cls._brokers_lock:
+            if name not in cls._brokers:
+                cls._brokers[name] = cls()
+            return cls._brokers[name]
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.exchanges = {} # name -> (type, [(routing_key, queue.Queue),])
+        self.queues = {} # name -> queue.Queue shared by its consumers
+
+    def exchange_declare(self, exchange_name, exchange_type):
+        with self._lock:
+            known = self.exchanges.setdefault(exchange_name, (exchange_type, []))
+            if known[0] != exchange_type:
+                raise ValueError('exchange %s already declared as %s' % (exchange_name, known[0]))
+
+    def bind(self, exchange_name, routing_key, inbox):
+        with self._lock:
+            bindings = self.exchanges[exchange_name][1]
+            if (routing_key, inbox) not in bindings: # named queue may be bound by each consumer
+                bindings.append((routing_key, inbox))
+
+    def queue_declare(self, queue_name):
+        '''named queue, the same one for every consumer'''
+        with self._lock:
+            return self.queues.setdefault(queue_name, queue.Queue())
+
+    def unbind(self, inbox):
+        with self._lock:
+            for _, bindings in self.exchanges.values():
+                bindings[:] = [b for b in bindings if b[1] is not inbox]
+
+    def publish(self, exchange_name, routing_key, body, properties):
+        '''route message object to bound queues, return number of queues'''
+        with self._lock:
+            exchange_type, bindings = self.exchanges[exchange_name]
+            if exchange_type == 'fanout':
+                targets = [inbox for _, inbox in bindings]
+            elif exchange_type == 'topic':
+                targets = [inbox for key, inbox in bindings if topic_matches(key, routing_key)]
+            else:
+                targets = [inbox for key, inbox in bindings if key == routing_key]
+        for inbox in targets:
+            inbox.put((body, properties))
+        return len(targets)
+
+
+class InprocTransport:
+    def __init__(self, host=INPROC_SCHEME):
+        self.broker = InprocBroker.instance(host)
+
+    def publisher(self, exchange_type, exchange_name, confirm=False, window=256):
+        return InprocPublisher(self.broker, exchange_type, exchange_name, confirm)
+
+    def subscribe(self, exchange_type, exchange_name, routing_key=''):
+        return InprocSubscription(self.broker, exchange_type, exchange_name, routing_key)
+
+    def work_queue(self, exchange_type, exchange_name, queue_name, routing_key='', prefetch=1):
+        return InprocWorkQueue(self.broker, exchange_type, exchange_name, queue_name, routing_key)
+
+    def close(self):
+        pass
+
+
+class InprocPublisher:
+    '''publishes message objects as is, confirms are immediate'''
+
+    def __init__(self, broker, exchange_type, exchange_name, confirm):
+        self.broker = broker
+        self.exchange_name = exchange_name
+        self.confirm = confirm
+        self.broker.exchange_declare(exchange_name, exchange_type)
+
+    def publish(self, body, routing_key, properties):
+        self.broker.publish(self.exchange_name, routing_key, body, properties)
+        return _resolved(True) if self.confirm else None
+
+    def publish_many(self, msgs, properties):
+        futures = [self.publish(body, routing_key, properties) for body, routing_key in msgs]
+        return futures if self.confirm else None
+
+    def wait_for_confirms(self, timeout=None):
+        return True
+
+    def process_data_events(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class InprocSubscription:
+    '''anonymous queue bound to exchange'''
+
+    _WAKEUP = object()
+
+    def __init__(self, broker, exchange_type, exchange_name, routing_key):
+        self.broker = broker
+        self.inbox = queue.Queue()
+        self.broker.exchange_declare(exchange_name, exchange_type)
+        self.broker.bind(exchange_name, routing_key, self.inbox)
+
+    def consume(self, inactivity_timeout=1):
+        '''yields (body, properties), None on inactivity timeout or wakeup()'''
+        while True:
+            try:
+                message = self.inbox.get(timeout=inactivity_timeout)
+            except queue.Empty:
+                yield None
+                continue
+            yield None if message is self._WAKEUP else message
+
+    def wakeup(self):
+        '''(thread-safe) make consume() yield at once'''
+        self.inbox.put(self._WAKEUP)
+
+    def close(self):
+        self.broker.unbind(self.inbox)
+
+
+class InprocWorkQueue:
+    '''named queue shared by consumers of the process, nack with requeue puts message back'''
+
+    _WAKEUP = object()
+
+    def __init__(self, broker, exchange_type, exchange_name, queue_name, routing_key):
+        self.broker = broker
+        self.broker.exchange_declare(exchange_name, exchange_type)
+        self.inbox = self.broker.queue_declare(queue_name)
+        self.broker.bind(exchange_name, routing_key, self.inbox)
+        self._unacked = {} # delivery_tag -> message, in delivery order
+        self._next_tag = 1
+
+    def consume(self, inactivity_timeout=1):
+        '''yields (body, properties, delivery_tag), None on inactivity timeout or wakeup()'''
+        while True:
+            try:
+                message = self.inbox.get(timeout=inactivity_timeout)
+            except queue.Empty:
+                yield None
+                continue
+            if message is self._WAKEUP:
+                yield None
+                continue
+            tag = self._next_tag
+            self._next_tag += 1
+            self._unacked[tag] = message
+            yield message[0], message[1], tag
+
+    def ack(self, delivery_tag, multiple=False):
+        for tag in self._settled(delivery_tag, multiple):
+            del self._unacked[tag]
+
+    def nack(self, delivery_tag, multiple=False, requeue=True):
+        for tag in self._settled(delivery_tag, multiple):
+            message = self._unacked.pop(tag)
+            if requeue:
+                self.inbox.put(message)
+
+    def wakeup(self):
+        '''(thread-safe) make consume() yield at once'''
+        self.inbox.put(self._WAKEUP)
+
+    def close(self):
+        for message in self._unacked.values():
+            self.inbox.put(message) # not acked - back to the queue
+        self._unacked.clear()
+
+    def _settled(self, delivery_tag, multiple):
+        return [tag for tag in self._unacked if tag <= delivery_tag] if multiple else [delivery_tag]
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+'''
+Camera recordings catalog (shared by cam_ffmpeg_srv & tools).
+
+ffmpeg records fixed-duration segments, every completed segment is a row of
+Segments clustered by (cam_id, start_ts), so "camera X at time T" is one
+index seek. Retention deletes old segments in bulk by end_ts index.
+
+Leases record which worker owns (records) a camera. A worker takes the
+lease when it starts recording and renews it by heartbeats; the lease of
+a dead worker expires and can be taken by another one.
+
+Leases exclude only workers using the same catalog, so its path
+(Config.CAM_CATALOG_PATH, cam_ffmpeg_srv --catalog) must be storage shared
+by all workers; workers with separate catalogs record the same camera
+twice. SQLite limits this to workers of one host: its file locking is not
+reliable over network file systems (NFS, SMB), a cluster of hosts needs
+the catalog in a database server.
+Usage:
+    python ./cam_catalog.py find <cam_id> <time> [<until>]
+    python ./cam_catalog.py sweep <days>
+
+    time  epoch seconds or 'YYYY-mm-dd HH:MM:SS' (local time)
+'''
+
+import os
+import sqlite3
+import sys
+import time
+from config import Config
+
+######################################################
+## schema
+
+DB_PATH = Config.CAM_CATALOG_PATH
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS Segments (
+       cam_id INTEGER NOT NULL,
+       start_ts INTEGER NOT NULL, -- epoch milliseconds
+       end_ts INTEGER NOT NULL, -- epoch milliseconds
+       path TEXT NOT NULL,
+       bytes INTEGER NOT NULL,
+       PRIMARY KEY (cam_id, start_ts)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS Segments_end ON Segments (end_ts);
+CREATE TABLE IF NOT EXISTS Leases (
+       cam_id INTEGER PRIMARY KEY,
+       worker TEXT NOT NULL,
+       expires_ts INTEGER NOT NULL -- epoch milliseconds
+);
+CREATE INDEX IF NOT EXISTS Leases_worker ON Leases (worker);
+'''
+
+# restarted ffmpeg may register the same start again
+INSERT_SQL = 'INSERT OR REPLACE INTO Segments (cam_id,start_ts,end_ts,path,bytes) VALUES(?,?,?,?,?)'
+
+# last segment started at or before ts
+SEGMENT_AT_SQL = '''
+    SELECT cam_id,start_ts,end_ts,path,bytes FROM Segments
+    WHERE cam_id = ? AND start_ts <= ?
+    ORDER BY start_ts DESC LIMIT 1
+'''
+
+# segments overlapping [t1, t2], starting from the one covering t1
+SEGMENTS_SQL = '''
+    SELECT cam_id,start_ts,end_ts,path,bytes FROM Segments
+    WHERE cam_id = ? AND start_ts <= ? AND end_ts >= ? AND start_ts >= coalesce(
+        (SELECT max(start_ts) FROM Segments WHERE cam_id = ? AND start_ts <= ?), 0)
+    ORDER BY start_ts
+'''
+
+EXPIRED_SQL = 'SELECT cam_id,start_ts,path FROM Segments WHERE end_ts < ? ORDER BY end_ts LIMIT ?'
+DELETE_SQL = 'DELETE FROM Segments WHERE cam_id = ? AND start_ts = ?'
+
+# taken if free, expired or already ours
+TAKE_LEASE_SQL = '''
+    INSERT INTO Leases (cam_id,worker,expires_ts) VALUES(?,?,?)
+    ON CONFLICT (cam_id) DO UPDATE SET worker = excluded.worker, expires_ts = excluded.expires_ts
+    WHERE worker = excluded.worker OR expires_ts < ?
+'''
+
+def open_db(path=DB_PATH):
+    '''connect to db and create tables if needed'''
+    db = sqlite3.connect(path)
+    db.executescript(SCHEMA)
+    db.commit()
+    return db
+
+def add_segments(db, rows):
+    '''register completed segments, rows are (cam_id, start_ts, end_ts, path, bytes)'''
+    db.executemany(INSERT_SQL, rows)
+    db.commit()
+
+def segment_at(db, cam_id, ts):
+    '''segment row recorded at ts (epoch ms) or None'''
+    row = db.execute(SEGMENT_AT_SQL, (cam_id, ts)).fetchone()
+    return row if row and row[2] >= ts else None
+
+def segments_between(db, cam_id, t1, t2):
+    '''segment rows of [t1, t2] (epoch ms) in time order'''
+    return db.execute(SEGMENTS_SQL, (cam_id, t2, t1, cam_id, t1)).fetchall()
+
+def sweep(db, before_ts, limit=1000):
+    '''delete up to limit segments ended before before_ts (epoch ms) with their files, returns count'''
+    rows = db.execute(EXPIRED_SQL, (before_ts, limit)).fetchall()
+    for _, _, path in rows:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass # already deleted
+        except OSError as e:
+            print('Cant delete segment:', e)
+    db.executemany(DELETE_SQL, ((cam_id, start_ts) for cam_id, start_ts, _ in rows))
+    db.commit()
+    return len(rows)
+
+def now_ms():
+    return int(time.time() * 1000)
+
+def take_lease(db, cam_id, worker, ttl):
+    '''try to own cam_id for ttl sec, True if taken'''
+    now = now_ms()
+    taken = db.execute(TAKE_LEASE_SQL, (cam_id, worker, now + int(ttl * 1000), now)).rowcount == 1
+    db.commit()
+    return taken
+
+def lease_owner(db, cam_id):
+    '''worker owning cam_id or None'''
+    row = db.execute('SELECT worker FROM Leases WHERE cam_id = ? AND expires_ts >= ?', (cam_id, now_ms())).fetchone()
+    return row[0] if row else None
+
+def renew_leases(db, worker, ttl):
+    '''heartbeat, prolongs all leases of worker for ttl sec, returns cam_ids still owned'''
+    db.execute('UPDATE Leases SET expires_ts = ? WHERE worker = ?', (now_ms() + int(ttl * 1000), worker))
+    db.commit()
+    return {cam_id for cam_id, in db.execute('SELECT cam_id FROM Leases WHERE worker = ?', (worker,))}
+
+def release_lease(db, cam_id, worker):
+    db.execute('DELETE FROM Leases WHERE cam_id = ? AND worker = ?', (cam_id, worker))
+    db.commit()
+
+def release_leases(db, worker):
+    db.execute('DELETE FROM Leases WHERE worker = ?', (worker,))
+    db.commit()
+
+######################################################
+# main
+
+def parse_time(arg):
+    '''epoch seconds or local 'YYYY-mm-dd HH:MM:SS' -> epoch ms'''
+    try:
+        seconds = float(arg)
+    except ValueError:
+        seconds = time.mktime(time.strptime(arg, '%Y-%m-%d %H:%M:%S'))
+    return int(seconds * 1000)
+
+def format_ts(ts):
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(ts / 1000))
+
+if __name__ == '__main__':
+    if len(sys.argv) >= 4 and sys.argv[1] == 'find':
+        db = open_db()
+        cam_id, t1 = int(sys.argv[2]), parse_time(sys.argv[3])
+        if len(sys.argv) > 4:
+            rows = segments_between(db, cam_id, t1, parse_time(sys.argv[4]))
+        else:
+            rows = [row for row in [segment_at(db, cam_id, t1)] if row]
+        for _, start_ts, end_ts, path, size in rows:
+            print('%s  %s - %s  %d bytes  (seek %.1f s)' % (path, format_ts(start_ts), format_ts(end_ts),
+                size, max(0, t1 - start_ts) / 1000))
+        if not rows:
+            print('No recording of camera %d at %s' % (cam_id, format_ts(t1)))
+        db.close()
+    elif len(sys.argv) == 3 and sys.argv[1] == 'sweep':
+        db = open_db()
+        before_ts = int((time.time() - float(sys.argv[2]) * 86400) * 1000)
+        total = 0
+        while True:
+            count = sweep(db, before_ts)
+            total += count
+            if not count:
+                break
+        print(' [*] %d segments deleted' % total)
+        db.close()
+    else:
+        print(__doc__)
@@ -1,11 +1,39 @@
 #!/usr/bin/env python3
 '''
 ffmpeg server
+
+Worker takes start tasks while it has capacity: a free recording slot and,
+optionally, host CPU & disk write rate below thresholds. When full it cancels
+its tasks consumer (tasks flow to other workers) and resumes it when
+capacity is back.
+
+ffmpeg processes are supervised without blocking the AMQP loop: exits are
+reaped by a watcher thread (pidfd selector on Linux, polling elsewhere),
+stops are graceful ('q', then terminate, then kill on timers) and run in
+parallel, crashed recordings are restarted with backoff.
+
+A worker owns the cameras it records by leases in cam_catalog (renewed by
+heartbeats), a start of a camera owned by another worker is rejected.
+All workers must use the same catalog, i.e. run on one host (see
+cam_catalog for this limitation of SQLite).
+Stops are routed by cam_control direct exchange only to the owner's queue.
+Outcome of tasks is published to cam_status as acknowledgements:
+    {'id': cam_id, 'event': 'recording'|'stopped'|'rejected', 'worker': worker_id[, 'owner': worker_id]}
+
+Recordings are fixed-duration segments; completed segments are registered
+in cam_catalog and deleted by retention sweeper after --retention days.
+Usage:
+    python ./cam_ffmpeg_srv.py [--slots N] [--max-cpu PERCENT] [--max-disk MB_PER_SEC]
+        [--retention DAYS] [--catalog PATH]
 '''
 
 import pika
+import argparse, csv, os
 import signal, json
+import selectors, shlex, socket, threading
 import subprocess, time
+from functools import partial
+import cam_catalog
 from config import Config
 
 ######################################################
@@ -17,38 +45,345 @@ class Cfg:
     TASKS_EXCHANGE_NAME = 'cam_tasks'
     TASKS_ROUTE_KEY_FACILITY = 'cam.task'
     TASKS_WORKERS_QUEUE = 'cam_tasks_queue'
-    STOP_EXCHANGE_TYPE = 'fanout'
-    STOP_EXCHANGE_NAME = 'cam_stop'
+    CONTROL_EXCHANGE_TYPE = 'direct'
+    CONTROL_EXCHANGE_NAME = 'cam_control'
+    CONTROL_ROUTE_KEY_STOP = 'cam.stop' # + '.<cam_id>', bound to owner's queue
+    WORKER_QUEUE_PREFIX = 'cam_worker.' # + worker id
+    STATUS_EXCHANGE_TYPE = 'topic'
+    STATUS_EXCHANGE_NAME = 'cam_status'
+    STATUS_ROUTE_KEY_FACILITY = 'cam.status' # + '.<cam_id>'
+    LEASE_TTL_SEC = 30 # camera ownership without heartbeat
+    LEASE_RENEW_SEC = 10 # heartbeat period
+    MAX_SLOTS = 8 # concurrent recordings per worker
+    MAX_CPU_PERCENT = None # host CPU busy threshold, None - not checked
+    MAX_DISK_MBPS = None # host disk write MB/s threshold, None - not checked
+    LOAD_CHECK_SEC = 5 # period of load sampling
+    STOP_GRACE_SEC = 5 # wait after 'q' before terminate
+    STOP_KILL_SEC = 2 # wait after terminate before kill
+    RESTART_MIN_SEC = 1 # first restart delay of crashed recording
+    RESTART_MAX_SEC = 60 # restart delay limit
+    RESTART_RESET_SEC = 60 # ran that long - next crash restarts with min delay
+    REAP_POLL_SEC = 0.5 # exit polling period where pidfd is not available
+    RECORDS_DIR = '.'
+    SEGMENT_SEC = 60 # recording segment duration
+    SEGMENT_SCAN_SEC = 5 # period of completed segments registration
+    RETENTION_DAYS = 7 # 0 - keep forever
+    SWEEP_SEC = 60 # period of retention sweep
+    SWEEP_BATCH = 1000 # segments deleted per sweep step
+    CATALOG_PATH = Config.CAM_CATALOG_PATH # shared by all workers
 
-cmd_template = 'ffmpeg -i %s -an -vcodec copy -y -v quiet %s'
-#cmd_template = 'ffmpeg -i %s -an -vcodec copy -y %s'
-#cmd = cmd_template % (source_uri, filename.avi)
+cmd_template = 'ffmpeg -i %s -an -vcodec copy -y -v quiet -f segment -segment_time %d -reset_timestamps 1 ' \
+    '-strftime 1 -segment_list %s -segment_list_type csv %s'
+#cmd = cmd_template % (source_uri, segment_sec, list.csv, filename_%Y-%m-%d_%H-%M-%S.mp4)
 
 class CamHandler:
+    '''one camera recording, all methods are called on AMQP thread'''
+
     def __init__(self, cam_id, source_uri):
         self.cam_id = cam_id
         self.source_uri = source_uri
-        dt = time.strftime('%Y-%m-%d_%H-%M-%S', time.localtime())
-        self.filename = 'video_id_%d_%s.mp4' % (cam_id, dt)
+        self.filename = os.path.join(Cfg.RECORDS_DIR, 'video_id_%d_%%Y-%%m-%%d_%%H-%%M-%%S.mp4' % cam_id)
+        self.list_filename = os.path.join(Cfg.RECORDS_DIR, 'video_id_%d.csv' % cam_id) # completed segments
+        self.list_offset = 0 # registered part of list
         self.ffmpeg = None
+        self.started = None # time of last ffmpeg start
+        self.stopping = False
+        self.restarts = 0 # crashes in a row
+        self.timer = None # pending restart or stop escalation
 
     def start(self):
         global cmd_template
-        if self.ffmpeg is None or self.ffmpeg.poll() is not None:
-            cmd = cmd_template % (self.source_uri, self.filename)
+        self._cancel_timer()
+        if not self.running():
+            self.list_offset = 0 # ffmpeg rewrites the list
+            cmd = cmd_template % (self.source_uri, Cfg.SEGMENT_SEC, self.list_filename, self.filename)
             print('Start cam_id', self.cam_id, ', cmd =', cmd)
-            self.ffmpeg = subprocess.Popen(cmd, stdin=subprocess.PIPE, universal_newlines=True)
+            self.ffmpeg = subprocess.Popen(shlex.split(cmd), stdin=subprocess.PIPE,
+                universal_newlines=True, start_new_session=True) # CTRL+C is not passed to ffmpeg
+            self.started = time.time()
+            reaper.watch(self.ffmpeg, partial(self.on_exit, self.ffmpeg))
 
     def stop(self):
-        if self.ffmpeg is not None and self.ffmpeg.poll() is None:
+        '''graceful stop, returns at once, escalates to terminate & kill by timers'''
+        self.stopping = True
+        self._cancel_timer()
+        if self.running():
+            try:
+                self.ffmpeg.stdin.write('q')
+                self.ffmpeg.stdin.close()
+            except OSError:
+                pass
+            self.timer = connection.call_later(Cfg.STOP_GRACE_SEC, self._terminate)
+
+    def _terminate(self):
+        self.timer = None
+        if self.running():
+            print('Cant stop ffmpeg of cam_id', self.cam_id, '. Terminate it.')
+            self.ffmpeg.terminate()
+            self.timer = connection.call_later(Cfg.STOP_KILL_SEC, self._kill)
+
+    def _kill(self):
+        self.timer = None
+        if self.running():
+            print('Cant terminate ffmpeg of cam_id', self.cam_id, '. Kill it.')
+            self.ffmpeg.kill()
+
+    def _cancel_timer(self):
+        if self.timer is not None:
+            connection.remove_timeout(self.timer)
+            self.timer = None
+
+    def collect_segments(self):
+        '''catalog rows of segments completed since last call'''
+        try:
+            with open(self.list_filename, 'rb') as f:
+                f.seek(self.list_offset)
+                data = f.read()
+        except FileNotFoundError:
+            return []
+        data = data[:data.rfind(b'\n') + 1] # complete lines only
+        self.list_offset += len(data)
+
+        rows = []
+        for name, start, end in csv.reader(data.decode('utf8').splitlines()):
+            path = os.path.join(Cfg.RECORDS_DIR, name)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            end_ts = int(st.st_mtime * 1000) # closed when completed
+            rows.append((self.cam_id, end_ts - int((float(end) - float(start)) * 1000), end_ts, path, st.st_size))
+        return rows
+
+    def on_exit(self, ffmpeg):
+        '''ffmpeg process exited (called on AMQP thread by reaper)'''
+        if ffmpeg is not self.ffmpeg:
+            return # stale, already restarted
+        cam_catalog.add_segments(catalog, self.collect_segments()) # the last one
+        if self.stopping:
+            self._cancel_timer()
+            stopping.discard(self)
+            print('Stop cam_id', self.cam_id, 'ok, rc =', ffmpeg.returncode)
+            publish_status(self.cam_id, 'stopped')
+            return
+
+        # crashed - restart with backoff
+        if time.time() - self.started >= Cfg.RESTART_RESET_SEC:
+            self.restarts = 0
+        delay = min(Cfg.RESTART_MAX_SEC, Cfg.RESTART_MIN_SEC * 2 ** self.restarts)
+        self.restarts += 1
+        print(' [!] ffmpeg of cam_id %d exited (rc %s), restart in %.1f s' % (self.cam_id, ffmpeg.returncode, delay))
+        self.timer = connection.call_later(delay, self.start)
+
+    def running(self):
+        return self.ffmpeg is not None and self.ffmpeg.poll() is None
+
+cameras = {} # cam_id -> CamHandler being recorded (incl. waiting for restart)
+stopping = set() # stopped CamHandlers until their ffmpeg exits
+
+######################################################
+# ffmpeg exits watcher
+
+class Reaper:
+    '''
+    Watches ffmpeg processes on its own thread, on_exit callbacks are passed
+    to AMQP thread. Linux: waits on pidfds in selector, else polls.
+    '''
+
+    def __init__(self, connection):
+        self.connection = connection
+        self._lock = threading.Lock()
+        self._watched = {} # Popen -> (pidfd or None, on_exit)
+        self._closing = False
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self._wake_r, selectors.EVENT_READ)
+        self._thread = threading.Thread(target=self._run, name='ffmpeg-reaper', daemon=True)
+        self._thread.start()
+
+    def watch(self, proc, on_exit):
+        '''on_exit() is called on AMQP thread when proc exits'''
+        pidfd = None
+        if hasattr(os, 'pidfd_open'):
             try:
-                self.ffmpeg.communicate(input='q', timeout=1)
-                print('Stop cam_id', self.cam_id, 'ok')
-            except subprocess.TimeoutExpired:
-                print('Cant stop ffmpeg. Kill it.')
-                self.ffmpeg.kill()
+                pidfd = os.pidfd_open(proc.pid) # right after Popen, pid can not be reused yet
+            except OSError:
+                pass
+        with self._lock:
+            self._watched[proc] = (pidfd, on_exit)
+        self._wake()
+
+    def close(self):
+        self._closing = True
+        self._wake()
+        self._thread.join()
+        self._selector.close()
+        self._wake_r.close()
+        self._wake_w.close()
+
+    def _wake(self):
+        try:
+            self._wake_w.send(b'x')
+        except OSError:
+            pass # wake up buffer is full, it is awake anyway
+
+    def _run(self):
+        registered = set()
+        while not self._closing:
+            with self._lock:
+                watched = dict(self._watched)
+            for proc, (pidfd, _) in watched.items():
+                if pidfd is not None and pidfd not in registered:
+                    self._selector.register(pidfd, selectors.EVENT_READ)
+                    registered.add(pidfd)
+
+            polling = any(pidfd is None for pidfd, _ in watched.values())
+            for key, _ in self._selector.select(Cfg.REAP_POLL_SEC if polling else None):
+                if key.fileobj is self._wake_r:
+                    try:
+                        while self._wake_r.recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+
+            for proc, (pidfd, on_exit) in watched.items():
+                if proc.poll() is None:
+                    continue
+                with self._lock:
+                    del self._watched[proc]
+                if pidfd is not None:
+                    self._selector.unregister(pidfd)
+                    registered.discard(pidfd)
+                    os.close(pidfd)
+                self.connection.add_callback_threadsafe(on_exit)
+
+######################################################
+# capacity
 
-cameras = {}
+class HostLoad:
+    '''host CPU busy % and disk write rate from /proc (Linux), None where unavailable'''
+
+    def __init__(self):
+        self.cpu_percent = None
+        self.disk_mbps = None
+        self._cpu_prev = None # (busy, total) jiffies
+        self._disk_prev = None # (time, bytes written)
+
+    def sample(self):
+        try:
+            with open('/proc/stat') as f:
+                fields = [int(x) for x in f.readline().split()[1:]]
+            busy, total = sum(fields) - fields[3] - fields[4], sum(fields) # without idle & iowait
+            if self._cpu_prev and total > self._cpu_prev[1]:
+                self.cpu_percent = 100.0 * (busy - self._cpu_prev[0]) / (total - self._cpu_prev[1])
+            self._cpu_prev = (busy, total)
+        except (OSError, ValueError, IndexError):
+            self.cpu_percent = None
+
+        try:
+            disks = set(os.listdir('/sys/block')) # whole disks, partitions are not counted twice
+            written = 0
+            with open('/proc/diskstats') as f:
+                for line in f:
+                    fields = line.split()
+                    if fields[2] in disks:
+                        written += int(fields[9]) * 512 # sectors written
+            now = time.time()
+            if self._disk_prev and now > self._disk_prev[0]:
+                self.disk_mbps = (written - self._disk_prev[1]) / (now - self._disk_prev[0]) / 1e6
+            self._disk_prev = (now, written)
+        except (OSError, ValueError, IndexError):
+            self.disk_mbps = None
+
+host_load = HostLoad()
+
+def running_count():
+    return len(cameras)
+
+def full_reason():
+    '''why the worker can not take one more recording, None if it can'''
+    running = running_count()
+    if running >= Cfg.MAX_SLOTS:
+        return 'slots %d/%d' % (running, Cfg.MAX_SLOTS)
+    if Cfg.MAX_CPU_PERCENT is not None and host_load.cpu_percent is not None \
+            and host_load.cpu_percent >= Cfg.MAX_CPU_PERCENT:
+        return 'cpu %.0f%%' % host_load.cpu_percent
+    if Cfg.MAX_DISK_MBPS is not None and host_load.disk_mbps is not None \
+            and host_load.disk_mbps >= Cfg.MAX_DISK_MBPS:
+        return 'disk %.1f MB/s' % host_load.disk_mbps
+    return None
+
+tasks_consumer_tag = None # None while paused
+
+def update_admission():
+    '''pause tasks consumer when full, resume when capacity is back'''
+    global tasks_consumer_tag
+    reason = full_reason()
+    if reason and tasks_consumer_tag is not None:
+        channel.basic_cancel(tasks_consumer_tag) # not dispatched messages are requeued
+        tasks_consumer_tag = None
+        print(' [!] Full (%s), tasks paused' % reason)
+    elif not reason and tasks_consumer_tag is None:
+        tasks_consumer_tag = channel.basic_consume(queue=Cfg.TASKS_WORKERS_QUEUE,
+            on_message_callback=callback_start_task) # round robin
+        print(' [*] Tasks resumed, %d/%d slots used' % (running_count(), Cfg.MAX_SLOTS))
+
+def on_load_check():
+    host_load.sample()
+    update_admission()
+    connection.call_later(Cfg.LOAD_CHECK_SEC, on_load_check)
+
+######################################################
+# segments catalog
+
+def on_segments_scan():
+    rows = []
+    for cam in list(cameras.values()) + list(stopping):
+        rows.extend(cam.collect_segments())
+    if rows:
+        cam_catalog.add_segments(catalog, rows)
+    connection.call_later(Cfg.SEGMENT_SCAN_SEC, on_segments_scan)
+
+def on_retention_sweep():
+    '''deletes expired segments by batches, not to hold AMQP loop for long'''
+    before_ts = int((time.time() - Cfg.RETENTION_DAYS * 86400) * 1000)
+    count = cam_catalog.sweep(catalog, before_ts, Cfg.SWEEP_BATCH)
+    if count:
+        print(' [*] Retention: %d segments deleted' % count)
+    connection.call_later(0 if count == Cfg.SWEEP_BATCH else Cfg.SWEEP_SEC, on_retention_sweep)
+
+######################################################
+# cameras ownership
+
+worker_id = '%s.%d' % (socket.gethostname(), os.getpid())
+
+def stop_route_key(cam_id):
+    return Cfg.CONTROL_ROUTE_KEY_STOP + '.' + str(cam_id)
+
+def publish_status(cam_id, event, **fields):
+    '''task acknowledgement for controllers'''
+    msg = dict(id=cam_id, event=event, worker=worker_id, **fields)
+    channel.basic_publish(exchange=Cfg.STATUS_EXCHANGE_NAME,
+        routing_key=Cfg.STATUS_ROUTE_KEY_FACILITY + '.' + str(cam_id), body=bytes(json.dumps(msg), "utf8"))
+
+def stop_camera(cam_id):
+    '''stop recording, does not wait for ffmpeg exit, releases ownership'''
+    cam = cameras.pop(cam_id)
+    cam.stop()
+    if cam.running():
+        stopping.add(cam) # 'stopped' on exit
+    else:
+        publish_status(cam_id, 'stopped')
+    channel.queue_unbind(exchange=Cfg.CONTROL_EXCHANGE_NAME, queue=worker_queue, routing_key=stop_route_key(cam_id))
+    cam_catalog.release_lease(catalog, cam_id, worker_id)
+
+def on_lease_heartbeat():
+    owned = cam_catalog.renew_leases(catalog, worker_id, Cfg.LEASE_TTL_SEC)
+    for cam_id in [cam_id for cam_id in cameras if cam_id not in owned]:
+        print(' [!] Lease of cam_id %d is lost, stop it' % cam_id) # expired & taken by another worker
+        stop_camera(cam_id)
+    connection.call_later(Cfg.LEASE_RENEW_SEC, on_lease_heartbeat)
 
 ######################################################
 # work callbacks
@@ -63,19 +398,34 @@ def callback_start_task(ch, method, properties, body):
     msg = json.loads(jmsg)
     cam_id, cam_source_url = msg
 
-    # Note: with the help of some global atomics make sure that the process is not yet running
+    #no free capacity - return the task to the queue for other workers
+    reason = None if cam_id in cameras else full_reason()
+    if reason:
+        print(' [!] Full (%s), task rejected' % reason)
+        ch.basic_nack(delivery_tag=method.delivery_tag, requeue=True)
+        connection.call_later(0, update_admission) # not from inside consumer callback
+        return
 
-    #register cam in local dictionary
+    #register cam in local dictionary, it is recorded only by the lease owner
     if cam_id in cameras:
         pass
-    else:
+    elif cam_catalog.take_lease(catalog, cam_id, worker_id, Cfg.LEASE_TTL_SEC):
         cameras[cam_id] = CamHandler(cam_id, cam_source_url)
+        channel.queue_bind(exchange=Cfg.CONTROL_EXCHANGE_NAME, queue=worker_queue, routing_key=stop_route_key(cam_id))
+    else:
+        owner = cam_catalog.lease_owner(catalog, cam_id)
+        print(' [!] cam_id %d is recorded by %s, duplicate start rejected' % (cam_id, owner))
+        publish_status(cam_id, 'rejected', owner=owner)
+        ch.basic_ack(delivery_tag=method.delivery_tag) # drop it, requeue will not help
+        return
 
     #start ffmpeg
     cameras[cam_id].start()
+    publish_status(cam_id, 'recording')
 
     # ACK for meter's message
-    ch.basic_ack(delivery_tag=method.delivery_tag)    
+    ch.basic_ack(delivery_tag=method.delivery_tag)
+    connection.call_later(0, update_admission)
 
 def callback_stop_task(ch, method, properties, body):
     '''consumer callback_stop_task'''
@@ -88,20 +438,33 @@ def callback_stop_task(ch, method, properties, body):
     msg = json.loads(jmsg)
     cam_id, _ = msg
 
-    #find & stop ffmpeg
+    #find & stop ffmpeg, does not wait for exit
     if cam_id in cameras:
-        cameras[cam_id].stop()
-        del cameras[cam_id]
+        stop_camera(cam_id)
 
     # ACK for meter's message
     ch.basic_ack(delivery_tag=method.delivery_tag)
+    connection.call_later(0, update_admission) # slot freed
 
 ######################################################
 # RabbitMQ part - create consumer worker
 
+parser = argparse.ArgumentParser(description='ffmpeg cameras recording worker')
+parser.add_argument('--slots', type=int, default=Cfg.MAX_SLOTS)
+parser.add_argument('--max-cpu', type=float, default=Cfg.MAX_CPU_PERCENT)
+parser.add_argument('--max-disk', type=float, default=Cfg.MAX_DISK_MBPS)
+parser.add_argument('--retention', type=float, default=Cfg.RETENTION_DAYS)
+parser.add_argument('--catalog', default=Cfg.CATALOG_PATH, help='segments & leases db, the same for all workers')
+args = parser.parse_args()
+Cfg.MAX_SLOTS, Cfg.MAX_CPU_PERCENT, Cfg.MAX_DISK_MBPS = args.slots, args.max_cpu, args.max_disk
+Cfg.RETENTION_DAYS, Cfg.CATALOG_PATH = args.retention, args.catalog
+
+catalog = cam_catalog.open_db(Cfg.CATALOG_PATH)
+
 # create connection & channel
 connection = pika.BlockingConnection(pika.ConnectionParameters(host=Cfg.AMQP_HOST))
 channel = connection.channel()
+reaper = Reaper(connection)
 
 # declare tasks exchange, declare & bind round robin workers queue
 channel.exchange_declare(exchange=Cfg.TASKS_EXCHANGE_NAME, exchange_type=Cfg.TASKS_EXCHANGE_TYPE)
@@ -109,26 +472,44 @@ channel.queue_declare(Cfg.TASKS_WORKERS_QUEUE)
 channel.queue_bind(exchange=Cfg.TASKS_EXCHANGE_NAME, queue=Cfg.TASKS_WORKERS_QUEUE,
     routing_key=Cfg.TASKS_ROUTE_KEY_FACILITY + '.#')
 
-# declare stop-signal fanout exchange, declare & bind anonymous exclusive queue
-channel.exchange_declare(exchange=Cfg.STOP_EXCHANGE_NAME, exchange_type=Cfg.STOP_EXCHANGE_TYPE)
-queue_name = channel.queue_declare('', exclusive=True).method.queue
-channel.queue_bind(exchange=Cfg.STOP_EXCHANGE_NAME, queue=queue_name)
+# declare control exchange & exclusive worker queue, it is bound per owned camera
+channel.exchange_declare(exchange=Cfg.CONTROL_EXCHANGE_NAME, exchange_type=Cfg.CONTROL_EXCHANGE_TYPE)
+worker_queue = channel.queue_declare(Cfg.WORKER_QUEUE_PREFIX + worker_id, exclusive=True).method.queue
+
+# declare tasks status exchange
+channel.exchange_declare(exchange=Cfg.STATUS_EXCHANGE_NAME, exchange_type=Cfg.STATUS_EXCHANGE_TYPE)
 
 # configure consuming ops
 channel.basic_qos(prefetch_count=1) #enable long ops workers selecting in round robin
-channel.basic_consume(queue=Cfg.TASKS_WORKERS_QUEUE, on_message_callback=callback_start_task) # round robin
-channel.basic_consume(queue=queue_name, on_message_callback=callback_stop_task) # exclusive anonymous
+channel.basic_consume(queue=worker_queue, on_message_callback=callback_stop_task) # exclusive
+host_load.sample()
+update_admission() # starts tasks consumer (round robin)
+connection.call_later(Cfg.LOAD_CHECK_SEC, on_load_check)
+connection.call_later(Cfg.SEGMENT_SCAN_SEC, on_segments_scan)
+connection.call_later(Cfg.LEASE_RENEW_SEC, on_lease_heartbeat)
+if Cfg.RETENTION_DAYS:
+    connection.call_later(0, on_retention_sweep)
 
 def ctrl_c_handler(signum, frame):
     channel.stop_consuming() # gracefully stopping
 signal.signal(signal.SIGINT, ctrl_c_handler)
 
-print(' [*] Worker started. Waiting for camera tasks. To exit press CTRL+C')
+print(' [*] Worker %s started (%d slots). Waiting for camera tasks. To exit press CTRL+C' % (worker_id, Cfg.MAX_SLOTS))
 
 #run worker
 channel.start_consuming()
 
+#stop all recordings in parallel & wait for ffmpegs exit
+for cam_id in list(cameras):
+    stop_camera(cam_id)
+deadline = time.time() + Cfg.STOP_GRACE_SEC + Cfg.STOP_KILL_SEC + 1
+while stopping and time.time() < deadline:
+    connection.process_data_events(time_limit=0.1)
+cam_catalog.release_leases(catalog, worker_id)
+
 print(' [*] Worker stopped.')
 
 #cleanup
+reaper.close()
 connection.close() # close pika connection
+catalog.close()
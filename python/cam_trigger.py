@@ -1,10 +1,27 @@
 #!/usr/bin/env python3
 '''
+Camera trigger - starts & stops recording of one camera (Tk window), or
+of many cameras headless (--bulk).
+
+Bulk mode reads cameras from CSV (cam_id,uri rows) or JSON ([[cam_id, uri],],
+[{'id':, 'uri':},] or {cam_id: uri}) file, publishes tasks in rate-limited
+batches and reports time to 'recording' (or 'stopped') acknowledgement of
+cam_ffmpeg_srv per camera.
+Both modes run on one auto-reconnecting asyncio connection
+(amqp.async_consumer), Tk events are processed by the same loop.
+Usage:
+    python ./cam_trigger.py [<cam_id>]
+    python ./cam_trigger.py --bulk <file> [--stop] [--rate R] [--batch N] [--timeout S]
+
+    --rate   tasks per second
 '''
 
 import tkinter as tk
-import sys, os, queue, json
-import pika
+import argparse, csv, time
+import sys, os, json
+import asyncio
+from amqp.async_consumer import AsyncConsumer
+from tk_async import tk_mainloop
 from config import Config
 
 ######################################################
@@ -15,8 +32,15 @@ class Cfg:
     TASKS_EXCHANGE_TYPE = 'topic'
     TASKS_EXCHANGE_NAME = 'cam_tasks'
     TASKS_ROUTE_KEY_FACILITY = 'cam.task'
-    STOP_EXCHANGE_TYPE = 'fanout'
-    STOP_EXCHANGE_NAME = 'cam_stop'
+    CONTROL_EXCHANGE_TYPE = 'direct'
+    CONTROL_EXCHANGE_NAME = 'cam_control'
+    CONTROL_ROUTE_KEY_STOP = 'cam.stop' # routed to the worker owning the camera
+    STATUS_EXCHANGE_TYPE = 'topic'
+    STATUS_EXCHANGE_NAME = 'cam_status'
+    STATUS_ROUTE_KEY_FACILITY = 'cam.status'
+    BULK_RATE = 100 # tasks per sec
+    BULK_BATCH = 50 # tasks per batch
+    BULK_TIMEOUT = 60 # sec to wait for acknowledgements after the last batch
 
     DEFAULT_URI = 'rtsp://@192.168.21.166:8080/h264.sdp'
 
@@ -55,54 +79,157 @@ class CamTriggerFrame(tk.Frame):
 ######################################################
 # RabbitMQ part
 
-connection = pika.BlockingConnection(pika.ConnectionParameters(host=Cfg.AMQP_HOST))
-channel = connection.channel()
-channel.exchange_declare(exchange=Cfg.TASKS_EXCHANGE_NAME, exchange_type=Cfg.TASKS_EXCHANGE_TYPE)
-channel.exchange_declare(exchange=Cfg.STOP_EXCHANGE_NAME, exchange_type=Cfg.STOP_EXCHANGE_TYPE)
+# auto-reconnecting connection on asyncio loop, exchanges are declared on connect
+consumer = AsyncConsumer(Cfg.AMQP_HOST)
+consumer.declare_exchange(Cfg.TASKS_EXCHANGE_TYPE, Cfg.TASKS_EXCHANGE_NAME)
+consumer.declare_exchange(Cfg.CONTROL_EXCHANGE_TYPE, Cfg.CONTROL_EXCHANGE_NAME)
 
-def publish(exname, rkey, cam_id, source_uri):
-    global channel
+def publish(exname, rkey, cam_id, source_uri, quiet=False):
     msg = (cam_id, source_uri)
-    print(exname, msg)    
+    if not quiet:
+        print(exname, msg)
     jmsg = json.dumps(msg)
     bmsg = bytes(jmsg, "utf8")
-    channel.basic_publish(exchange=exname, routing_key=rkey, body=bmsg)
+    consumer.publish(exname, rkey, bmsg) # queued while disconnected
+
+######################################################
+## bulk part
+
+def load_cameras(path):
+    '''[(cam_id, uri)] of CSV or JSON file'''
+    with open(path, newline='') as f:
+        if path.lower().endswith('.json'):
+            data = json.load(f)
+            if isinstance(data, dict):
+                data = list(data.items())
+            return [(int(item['id']), item.get('uri')) if isinstance(item, dict) else (int(item[0]), item[1])
+                for item in data]
+        cameras = []
+        for row in csv.reader(f):
+            if not row or not row[0].strip().isdigit():
+                continue # header or empty line
+            cameras.append((int(row[0]), row[1].strip() if len(row) > 1 else None))
+        return cameras
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return float('nan')
+    k = min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))
+    return sorted_values[k]
+
+async def run_bulk(args):
+    cameras = load_cameras(args.bulk)
+    expected = 'stopped' if args.stop else 'recording'
+
+    try:
+        await asyncio.wait_for(consumer.connect(), args.timeout)
+    except asyncio.TimeoutError:
+        print(' [!] No connection to %s within %.0f s' % (Cfg.AMQP_HOST, args.timeout))
+        return
+
+    sent = {} # cam_id -> publish time
+    results = {} # cam_id -> (sec, event, worker)
+    acked = asyncio.Event() # set on each new result
+
+    def on_ack(body):
+        '''acknowledgement of cam_ffmpeg_srv'''
+        msg = json.loads(body)
+        cam_id = msg.get('id')
+        if cam_id in sent and cam_id not in results and msg.get('event') in (expected, 'rejected'):
+            results[cam_id] = (time.time() - sent[cam_id], msg['event'], msg.get('owner') or msg.get('worker'))
+            acked.set()
+
+    # returns when the queue is bound, acks are missed before that
+    sub = await consumer.subscribe(Cfg.STATUS_EXCHANGE_TYPE, Cfg.STATUS_EXCHANGE_NAME,
+        Cfg.STATUS_ROUTE_KEY_FACILITY + '.*', callback=on_ack)
+
+    print(' [*] %s %d cameras, %.0f tasks/s in batches of %d' % (
+        'Stopping' if args.stop else 'Starting', len(cameras), args.rate, args.batch))
+    started = time.time()
+    for i in range(0, len(cameras), args.batch):
+        await asyncio.sleep(max(0, started + i / args.rate - time.time())) # acks are handled meanwhile
+        for cam_id, source_uri in cameras[i:i + args.batch]:
+            if args.stop:
+                publish(Cfg.CONTROL_EXCHANGE_NAME, Cfg.CONTROL_ROUTE_KEY_STOP + '.' + str(cam_id), cam_id, None, quiet=True)
+            else:
+                publish(Cfg.TASKS_EXCHANGE_NAME, Cfg.TASKS_ROUTE_KEY_FACILITY + '.' + str(cam_id), cam_id,
+                    source_uri or Cfg.DEFAULT_URI, quiet=True)
+            sent[cam_id] = time.time()
+    published = time.time() - started
+
+    deadline = time.time() + args.timeout
+    while len(results) < len(sent):
+        acked.clear()
+        try:
+            await asyncio.wait_for(acked.wait(), max(0, deadline - time.time()))
+        except asyncio.TimeoutError:
+            break
+    sub.cancel()
+
+    # report
+    for cam_id, _ in cameras:
+        if cam_id in results:
+            sec, event, worker = results[cam_id]
+            print('%d\t%.3f s\t%s\t%s' % (cam_id, sec, event, worker))
+        else:
+            print('%d\t-\tno ack' % cam_id)
+    times = sorted(sec for sec, event, _ in results.values() if event == expected)
+    rejected = sum(1 for _, event, _ in results.values() if event == 'rejected')
+    print(' [*] published %d tasks in %.1f s, %s %d, rejected %d, no ack %d' % (
+        len(sent), published, expected, len(times), rejected, len(sent) - len(results)))
+    print(' [*] time to %s  p50 %.3f s  p99 %.3f s  max %.3f s' % (
+        expected, percentile(times, 50), percentile(times, 99), times[-1] if times else float('nan')))
 
 ######################################################
 # main
+
+async def bulk_main(args):
+    try:
+        await run_bulk(args)
+    finally:
+        await consumer.close()
+
+if '--bulk' in sys.argv[1:]:
+    parser = argparse.ArgumentParser(description='Headless bulk camera control')
+    parser.add_argument('--bulk', required=True, metavar='FILE', help='CSV or JSON cameras list')
+    parser.add_argument('--stop', action='store_true')
+    parser.add_argument('--rate', type=float, default=Cfg.BULK_RATE)
+    parser.add_argument('--batch', type=int, default=Cfg.BULK_BATCH)
+    parser.add_argument('--timeout', type=float, default=Cfg.BULK_TIMEOUT)
+    asyncio.run(bulk_main(parser.parse_args()))
+    sys.exit()
+
 cam_id = int(sys.argv[1]) if len(sys.argv) > 1 else os.getpid()
 routing_key = Cfg.TASKS_ROUTE_KEY_FACILITY + '.' + str(cam_id)
+stop_routing_key = Cfg.CONTROL_ROUTE_KEY_STOP + '.' + str(cam_id)
 
-root = tk.Tk()
-root.title('Camera ID ' + str(cam_id))
+async def main():
+    await consumer.connect()
 
-source_uri_var = tk.StringVar() # linked tkinter string var
-source_uri_var.set(Cfg.DEFAULT_URI)
+    root = tk.Tk()
+    root.title('Camera ID ' + str(cam_id))
 
-CamTriggerFrame(
-    root, font=('Arial',12),
-    source_uri_var = source_uri_var,
+    source_uri_var = tk.StringVar() # linked tkinter string var
+    source_uri_var.set(Cfg.DEFAULT_URI)
 
-    command_start = lambda:
-        publish(Cfg.TASKS_EXCHANGE_NAME, routing_key, cam_id, source_uri_var.get()),
+    CamTriggerFrame(
+        root, font=('Arial',12),
+        source_uri_var = source_uri_var,
 
-    command_stop = lambda:
-        publish(Cfg.STOP_EXCHANGE_NAME, routing_key, cam_id, None),
+        command_start = lambda:
+            publish(Cfg.TASKS_EXCHANGE_NAME, routing_key, cam_id, source_uri_var.get()),
 
-    ).pack(fill=tk.BOTH, expand=1)
+        command_stop = lambda:
+            publish(Cfg.CONTROL_EXCHANGE_NAME, stop_routing_key, cam_id, None),
 
-root.update() # completes any pending geometry 
-root.minsize(root.winfo_width(), root.winfo_height()) # set minimum window size
+        ).pack(fill=tk.BOTH, expand=1)
 
-# rabbit-heartbit
-def process_data_events():
-    connection.process_data_events()
-    root.after(500, process_data_events)
+    root.update() # completes any pending geometry 
+    root.minsize(root.winfo_width(), root.winfo_height()) # set minimum window size
 
-process_data_events() 
+    await tk_mainloop(root) # GUI mainloop, AMQP IO on the same loop
 
-root.protocol('WM_DELETE_WINDOW', lambda: root.quit())
-tk.mainloop()  # GUI mainloop
+    #cleanup
+    await consumer.close() # sends what is queued & closes connection
 
-#cleanup
-connection.close()
+asyncio.run(main())
@@ -2,6 +2,9 @@
 '''
 Simple chatting demo.
 Emits and consume messages into/from AMQP-exchange (Cfg.EXCHANGE_NAME).
+Publishing & consuming share one asyncio connection (amqp.async_consumer)
+which reconnects on drop. The same loop drives Tk events, so inbound
+messages are shown as soon as they arrive, without a consumer thread.
 Usage:
     python ./chat.py [<user_name>]
 '''
@@ -9,10 +12,10 @@ Usage:
 import tkinter as tk
 import sys
 import os
-import queue
+import asyncio
 
-from amqp.producer import Producer
-from amqp.consumer_thread import ConsumerThread
+from amqp.async_consumer import AsyncConsumer
+from tk_async import tk_mainloop
 from config import Config
 
 ######################################################
@@ -31,8 +34,7 @@ class ChatFrame(tk.Frame):
     def __init__(self, *args, **kwargs):
         '''init chat frame'''
         self.default_font = kwargs.pop('font', ('Arial', 12))
-        self.producer = kwargs.pop('producer', None)
-        self.queue = kwargs.pop('queue', None)
+        self.publish = kwargs.pop('publish', None)
         self.user_name = kwargs.pop('user_name', 'user_name')
 
         tk.Frame.__init__(self, *args, **kwargs)
@@ -55,67 +57,61 @@ class ChatFrame(tk.Frame):
         self.button_send.pack(side=tk.LEFT)
 
         self.edit.focus_set()
-        self.process_inbound()
 
     def on_send(self, event=None):
         '''handle sending'''
         msg = self.my_msg.get()
         self.my_msg.set("")  # clears input
         pubmsg = self.user_name + "> " + msg
-        self.producer.publish(pubmsg)
-        # todo: reconnect on drop
-
-    def process_inbound(self):
-        '''process inbound messages queue'''
-        while self.queue.qsize():
-            try:
-                msg = self.queue.get(0)
-                self.listbox.insert(tk.END, msg)
-
-                # clear selection
-                sel = self.listbox.curselection()
-                if (len(sel) > 0):
-                    self.listbox.selection_clear(sel[0], sel[-1])
-                
-                # select last line
-                self.listbox.selection_set(tk.END)
-                self.listbox.see(tk.END)
-            except queue.Empty:
-                pass
-        self.producer.process_data_events()
-        self.after(200, self.process_inbound)
+        self.publish(pubmsg) # queued & sent after reconnect on drop
 
+    def on_message(self, msg):
+        '''handle inbound message'''
+        self.listbox.insert(tk.END, msg)
 
-# main
-user_name = sys.argv[1] if len(sys.argv) > 1 else 'username-' + str(os.getpid())
+        # clear selection
+        sel = self.listbox.curselection()
+        if (len(sel) > 0):
+            self.listbox.selection_clear(sel[0], sel[-1])
+
+        # select last line
+        self.listbox.selection_set(tk.END)
+        self.listbox.see(tk.END)
+
+
+async def main(user_name):
+    consumer = AsyncConsumer(Cfg.AMQP_HOST)
+    await consumer.connect()
+    consumer.declare_exchange(Cfg.EXCHANGE_TYPE, Cfg.EXCHANGE_NAME)
+    publish = lambda msg: consumer.publish(Cfg.EXCHANGE_NAME, '', msg)
 
-msg_queue = queue.Queue()
+    root = tk.Tk()
+    root.title('Chat (' + user_name + ')')
 
-consumer_thread = ConsumerThread(msg_queue, Cfg.AMQP_HOST, Cfg.EXCHANGE_TYPE, Cfg.EXCHANGE_NAME)
-consumer_thread.start()
-producer = Producer(Cfg.AMQP_HOST, Cfg.EXCHANGE_TYPE, Cfg.EXCHANGE_NAME)
+    chat_frame = ChatFrame(
+        root, font=('Arial',12),
+        publish=publish, user_name=user_name
+        )
+    chat_frame.pack(fill=tk.BOTH, expand=1)
 
-root = tk.Tk()
-root.title('Chat (' + user_name + ')')
+    root.update() # completes any pending geometry 
+    root.minsize(root.winfo_width(), root.winfo_height()) # set minimum window size
 
-ChatFrame(
-    root, font=('Arial',12),
-    producer=producer, queue=msg_queue, user_name=user_name
-    ).pack(fill=tk.BOTH, expand=1)
+    await consumer.subscribe(Cfg.EXCHANGE_TYPE, Cfg.EXCHANGE_NAME, callback=chat_frame.on_message)
 
-root.update() # completes any pending geometry 
-root.minsize(root.winfo_width(), root.winfo_height()) # set minimum window size
+    # start chatting
+    publish('{enter} ' + user_name) # echo user entered
 
-# start chatting
-producer.publish('{enter} ' + user_name) # echo user entered
+    await tk_mainloop(root)  # GUI mainloop
 
-root.protocol('WM_DELETE_WINDOW', lambda: root.quit())
-tk.mainloop()  # GUI mainloop
+    # stop chatting
+    publish('{quit} ' + user_name) # echo user quiting
 
-# stop chatting
-consumer_thread.stop() # set stop-flag
-producer.publish('{quit} ' + user_name) # echo user quiting & also stimulate local consumer to check stop-flag
+    # cleanup
+    await consumer.close() # sends what is queued & closes connection
+
+
+# main
+user_name = sys.argv[1] if len(sys.argv) > 1 else 'username-' + str(os.getpid())
 
-# cleanup
-producer.close()
-consumer_thread.join() # wait exit
+asyncio.run(main(user_name))
@@ -3,4 +3,5 @@
 
 class Config:
     AMQP_HOST = 'localhost'
+    CAM_CATALOG_PATH = './cameras.sqlite_db' # must be the same file for all cam_ffmpeg_srv workers
 
@@ -2,13 +2,16 @@
 '''
 Meter emulator.
 Emits measuring values into AMQP-exchange (Cfg.EXCHANGE_NAME).
+Readings are encoded by Cfg.CONTENT_TYPE codec (compact binary by default).
 Usage:
     python ./meter_emu.py [<meter_id>]
 '''
 
 import tkinter as tk
-import sys, os, time, json, random
+import sys, os, time, random
+import pika
 from amqp.producer import Producer
+from amqp.codec import get_codec, JsonCodec, MeterReadingCodec
 from config import Config
 
 ######################################################
@@ -19,6 +22,7 @@ class Cfg:
     EXCHANGE_TYPE = 'topic'
     EXCHANGE_NAME = 'meters'
     ROUTE_KEY_FACILITY = 'meter'
+    CONTENT_TYPE = MeterReadingCodec.CONTENT_TYPE # or JsonCodec.CONTENT_TYPE
 
 class State:
     VALUE = 1
@@ -33,7 +37,12 @@ random.seed(time.time())
 meter_id = sys.argv[1] if len(sys.argv) > 1 else str(os.getpid())
 initial_value = int(sys.argv[2]) if len(sys.argv) > 2 else random.randint(0, 100)
 
-producer = Producer(Cfg.AMQP_HOST, Cfg.EXCHANGE_TYPE, Cfg.EXCHANGE_NAME)
+producer = Producer(Cfg.AMQP_HOST, Cfg.EXCHANGE_TYPE, Cfg.EXCHANGE_NAME, confirm=True)
+codec = get_codec(Cfg.CONTENT_TYPE)
+if codec.CONTENT_TYPE == MeterReadingCodec.CONTENT_TYPE and not MeterReadingCodec.fits_id(meter_id):
+    print(' [!] Meter id %r is not a uint32 number, readings are sent as JSON' % meter_id)
+    codec = get_codec(JsonCodec.CONTENT_TYPE)
+properties = pika.BasicProperties(content_type=codec.CONTENT_TYPE)
 
 root = tk.Tk()
 root.title('Meter-Emu, ID: ' + meter_id)
@@ -49,8 +58,9 @@ last_value = -1
 def meter_publish(msg):
     '''publish msg'''
     global producer, meter_id
-    jmsg = json.dumps(msg)
-    producer.publish(jmsg, Cfg.ROUTE_KEY_FACILITY + '.' + meter_id)
+    bmsg = codec.encode(msg)
+    confirmed = producer.publish(bmsg, Cfg.ROUTE_KEY_FACILITY + '.' + meter_id, properties)
+    confirmed.add_done_callback(lambda f: f.result() or print('Lost reading:', msg))
 
 def meter_reading():
     '''read & publish the value'''
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+'''
+Headless meter swarm - load generator & end-to-end benchmark.
+
+Spawns N virtual meters emitting readings through Producer, listens
+meters_db_updates and measures latency from reading emit time to insert
+in meters_srv (notification 'ins_ts') and to the notification receipt.
+Reports p50/p99 latencies and sustained throughput.
+Publishing starts once the notifications queue is bound. Without --local
+meters_srv (or meters_cluster) must be running, readings published before
+its queue exists are dropped by the broker.
+Usage:
+    python ./meter_swarm.py [--meters N] [--rate R] [--duration S]
+        [--dist uniform|normal|walk] [--json] [--local]
+
+    --rate   readings per second of each meter
+    --json   send JSON readings (as old emulators) instead of binary
+    --local  run against in-process broker (amqp.transport) and
+             in-process meters_srv (batch mode, in-memory db),
+             no RabbitMQ needed
+'''
+
+import argparse
+import json
+import queue
+import random
+import sys
+import time
+from types import SimpleNamespace
+from amqp.codec import get_codec, JsonCodec, MeterReadingCodec
+from amqp.producer import Producer
+from amqp.consumer_thread import ConsumerThread
+from amqp.transport import INPROC_SCHEME
+from meters_srv import MetersServer
+import meters_notify
+from config import Config
+
+######################################################
+## params
+
+class Cfg:
+    AMQP_HOST = Config.AMQP_HOST
+    EXCHANGE_TYPE = 'topic'
+    EXCHANGE_NAME = 'meters'
+    ROUTE_KEY_FACILITY = 'meter'
+    AFTER_UPD_EXCHANGE_TYPE = 'topic'
+    AFTER_UPD_EXCHANGE_NAME = 'meters_db_updates'
+    BASE_METER_ID = 100000 # virtual meters get ids BASE_METER_ID + i
+    TICK = 0.01 # sec between emit batches
+    DRAIN_TIMEOUT = 5 # sec to wait for late notifications
+
+class State:
+    VALUE = 1
+    ONLINE = 2
+    OFFLINE = 3
+
+######################################################
+## virtual meters
+
+class VirtualMeter:
+    def __init__(self, meter_id, dist, rnd):
+        self.meter_id = str(meter_id)
+        self.dist = dist
+        self.rnd = rnd
+        self.value = rnd.uniform(0, 100)
+
+    def read(self):
+        '''next value of configured distribution'''
+        if self.dist == 'normal':
+            self.value = self.rnd.gauss(50, 15)
+        elif self.dist == 'walk':
+            self.value += self.rnd.gauss(0, 2)
+        else:
+            self.value = self.rnd.uniform(0, 100)
+        self.value = min(100, max(0, self.value))
+        return self.value
+
+######################################################
+## stats
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return float('nan')
+    k = min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))
+    return sorted_values[k]
+
+class Stats:
+    def __init__(self, meter_ids):
+        self.meter_ids = set(meter_ids)
+        self.insert_ms = []
+        self.notify_ms = []
+
+    def on_notification(self, jmsg, recv_ts):
+        for meter_id, readings, ins_ts in meters_notify.updates(json.loads(jmsg)):
+            if str(meter_id) not in self.meter_ids:
+                continue
+            for ts, *_ in readings or []:
+                emit_ts = ts / 1000
+                if ins_ts is not None:
+                    self.insert_ms.append((ins_ts - emit_ts) * 1000)
+                self.notify_ms.append((recv_ts - emit_ts) * 1000)
+
+    def received(self):
+        return len(self.notify_ms)
+
+    def report(self, sent, lost, duration):
+        print(' [*] sent %d readings in %.1f s (%.0f/s), lost %d' % (sent, duration, sent / duration, lost))
+        print(' [*] stored & notified %d readings (%.0f/s sustained)' % (self.received(), self.received() / duration))
+        for name, values in (('emit->insert', self.insert_ms), ('emit->notify', self.notify_ms)):
+            values = sorted(values)
+            print(' [*] %-13s p50 %8.1f ms  p99 %8.1f ms  max %8.1f ms' % (
+                name, percentile(values, 50), percentile(values, 99), values[-1] if values else float('nan')))
+
+######################################################
+# main
+
+parser = argparse.ArgumentParser(description='Headless meter swarm load generator')
+parser.add_argument('--meters', type=int, default=100)
+parser.add_argument('--rate', type=float, default=1.0)
+parser.add_argument('--duration', type=float, default=10.0)
+parser.add_argument('--dist', choices=['uniform', 'normal', 'walk'], default='uniform')
+parser.add_argument('--json', action='store_true')
+parser.add_argument('--local', action='store_true')
+args = parser.parse_args()
+
+rnd = random.Random(time.time())
+meters = [VirtualMeter(Cfg.BASE_METER_ID + i, args.dist, rnd) for i in range(args.meters)]
+codec = get_codec(JsonCodec.CONTENT_TYPE if args.json else MeterReadingCodec.CONTENT_TYPE)
+stats = Stats(m.meter_id for m in meters)
+
+# create notifications consumer & readings producer
+host = INPROC_SCHEME if args.local else Cfg.AMQP_HOST
+notify_queue = queue.Queue()
+consumer = ConsumerThread(
+    notify_queue,
+    host,
+    Cfg.AFTER_UPD_EXCHANGE_TYPE,
+    Cfg.AFTER_UPD_EXCHANGE_NAME,
+    Cfg.ROUTE_KEY_FACILITY + '.*'
+)
+consumer.start()
+producer = Producer(host, Cfg.EXCHANGE_TYPE, Cfg.EXCHANGE_NAME, confirm=True)
+if args.local:
+    properties = SimpleNamespace(content_type=codec.CONTENT_TYPE)
+    srv = MetersServer(host, db_path=':memory:', batch=True)
+    srv.start()
+else:
+    import pika
+    properties = pika.BasicProperties(content_type=codec.CONTENT_TYPE)
+# readings queue is bound by MetersServer constructor, wait for notifications queue
+if not consumer.ready.wait(Cfg.DRAIN_TIMEOUT):
+    print(' [!] No subscription to %s within %d s' % (Cfg.AFTER_UPD_EXCHANGE_NAME, Cfg.DRAIN_TIMEOUT))
+    consumer.stop()
+    producer.close()
+    if args.local:
+        srv.stop()
+    sys.exit(1)
+
+def drain_notifications():
+    while True:
+        try:
+            jmsg = notify_queue.get_nowait()
+        except queue.Empty:
+            return
+        stats.on_notification(jmsg, time.time())
+
+print(' [*] %d meters x %.1f readings/s for %.0f s (%s)' % (
+    args.meters, args.rate, args.duration, host))
+
+# emit readings
+total_rate = args.meters * args.rate
+futures = []
+sent = 0
+next_meter = 0
+started = time.time()
+elapsed = 0
+
+while elapsed < args.duration:
+    due = int(elapsed * total_rate) - sent
+    msgs = []
+    for _ in range(due):
+        m = meters[next_meter]
+        next_meter = (next_meter + 1) % len(meters)
+        msg = {'id': m.meter_id, 'ts': time.time(), 'value': m.read(), 'state': State.VALUE}
+        msgs.append((codec.encode(msg), Cfg.ROUTE_KEY_FACILITY + '.' + m.meter_id))
+    if msgs:
+        futures.extend(producer.publish_many(msgs, properties) or [])
+        sent += len(msgs)
+    producer.process_data_events()
+    drain_notifications()
+    time.sleep(Cfg.TICK)
+    elapsed = time.time() - started
+
+duration = time.time() - started
+
+# wait for the tail of notifications
+deadline = time.time() + Cfg.DRAIN_TIMEOUT
+while stats.received() < sent and time.time() < deadline:
+    producer.process_data_events()
+    drain_notifications()
+    time.sleep(Cfg.TICK)
+
+producer.wait_for_confirms(timeout=Cfg.DRAIN_TIMEOUT)
+lost = sum(1 for f in futures if not f.done() or not f.result())
+
+stats.report(sent, lost, duration)
+
+# cleanup
+consumer.stop() # set stop-flag
+producer.close()
+consumer.join() # wait exit
+if args.local:
+    srv.stop()
+    srv.join()
@@ -1,5 +1,12 @@
 #!/usr/bin/env python3
 '''
+Live chart of meter readings.
+Usage:
+    python ./meter_view.py [<meter_id> [<window_sec>]]
+    python ./meter_view.py --dashboard [<meter_id> ...]
+
+    --dashboard  grid of small charts (all known meters if no ids given)
+                 in one window, one AMQP subscription & one grouped query
 '''
 
 import tkinter as tk
@@ -10,13 +17,20 @@ from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 from matplotlib.patches import Polygon
 import matplotlib.dates as mdates
 import matplotlib.pyplot as plt
+import numpy as np
 
 from datetime import datetime, timedelta
-import json, sqlite3
+import json
+import math
+import time
+from collections import deque
 
 import sys
-import queue
-from amqp.consumer_thread import ConsumerThread
+import asyncio
+from amqp.async_consumer import AsyncConsumer
+from tk_async import tk_mainloop
+from meters_db import open_db, to_ms, ROLLUPS
+import meters_notify
 from config import Config
 
 ######################################################
@@ -27,106 +41,500 @@ class Cfg:
     ROUTE_KEY_FACILITY = 'meter'
     AFTER_UPD_EXCHANGE_TYPE = 'topic'
     AFTER_UPD_EXCHANGE_NAME = 'meters_db_updates'
+    CACHE_POINTS = 4096 # per meter ring buffer size
+    LIVE_WINDOW = 65 # sec, default window
+    LIVE_WINDOW_MAX = 600 # sec, longer windows are read from rollups, not cached
+    BLIT = True # repaint only line & polygon over cached background
+    FRAME_STATS_SIZE = 1000 # frame times kept for stats
+    FRAME_STATS_LOG_SEC = 0 # print frame stats periodically, 0 - only on exit
+    DASHBOARD_MAX = 64 # max panels of dashboard
 
 ######################################################
 ## DB part
 
 class DB:
 
-    # parametric view-like query prefix
-    WITH_VIEW = '''
-        WITH
-        input(sel_id, d1, d2) AS ( SELECT :id, :d1, :d2 ),
-        prev_d(m_id, prev_d) AS (
-            SELECT meter_id, max([datetime]) FROM Metering, input
-            WHERE [datetime] < input.d1
-            GROUP BY meter_id
+    # view-like query prefix over meters(m_id),
+    # every step is a seek on MeteringTs (meter_id, ts) primary key
+    VIEW = '''
+        WITH RECURSIVE
+        {meters},
+        prev_t(m_id, prev_t) AS (
+            SELECT m_id, (SELECT max(ts) FROM MeteringTs WHERE meter_id = m_id AND ts < :t1)
+            FROM meters WHERE m_id IS NOT NULL
         ),
         vals AS (
             SELECT meter_id,
-                CASE WHEN [datetime] < d1 THEN d1 ELSE [datetime] END as dt,
+                max(ts, :t1) as dt,
                 value, [state]
-                , input.d1, input.d2, prev_d.prev_d
-            FROM Metering
-            CROSS JOIN input
-            LEFT JOIN prev_d ON m_id = meter_id
-            WHERE (input.sel_id IS NULL OR meter_id = input.sel_id)
-                AND (prev_d.prev_d IS NULL OR prev_d.prev_d <= [datetime])
-                AND [datetime] <= input.d2
+            FROM prev_t
+            JOIN MeteringTs ON meter_id = m_id
+            WHERE ts >= coalesce(prev_t, :t1) AND ts <= :t2
+        )
+        '''
+
+    # parametric meters (:id NULL selects all meters)
+    ALL_METERS = '''meters(m_id) AS (
+            SELECT coalesce(:id, (SELECT min(meter_id) FROM MeteringTs))
+            UNION ALL
+            SELECT (SELECT min(meter_id) FROM MeteringTs WHERE meter_id > m_id)
+            FROM meters WHERE :id IS NULL AND m_id IS NOT NULL
+        )'''
+
+    WITH_VIEW = VIEW.format(meters=ALL_METERS)
+
+    # distinct meters by skip-scan over primary key
+    KNOWN_METERS = '''
+        WITH RECURSIVE
+        meters(m_id) AS (
+            SELECT min(meter_id) FROM MeteringTs
+            UNION ALL
+            SELECT (SELECT min(meter_id) FROM MeteringTs WHERE meter_id > m_id)
+            FROM meters WHERE m_id IS NOT NULL
         )
+        SELECT m_id FROM meters WHERE m_id IS NOT NULL
+        '''
+
+    # buckets of one meter, the previous bucket is clamped to :t1 (as in WITH_VIEW)
+    ROLLUP_VALUES = '''
+        SELECT max(bucket, :t1), v_sum / n, v_min, v_max, v_last FROM {table}
+        WHERE meter_id = :id
+            AND bucket >= coalesce((SELECT max(bucket) FROM {table} WHERE meter_id = :id AND bucket < :t1), :t1)
+            AND bucket <= :t2
+        ORDER BY bucket
         '''
 
     def __init__(self):
         self.db = None
 
     def open(self):
-        self.db = sqlite3.connect('./storage.sqlite_db')
+        self.db = open_db()
 
     def close(self):
         self.db.close()
 
     def get_known_meters(self):
         c = self.db.cursor()
-        c.execute('SELECT DISTINCT meter_id FROM Metering')
+        c.execute(self.KNOWN_METERS)
         rows = c.fetchall()
         return list(map(lambda r: r[0], rows))
     
-    def get_values(self, meter_id, t1, t2):
-        d1 = t1.strftime('%Y-%m-%dT%H:%M:%S')
-        d2 = t2.strftime('%Y-%m-%dT%H:%M:%S')
+    @staticmethod
+    def rollup_table(t1, t2, width):
+        '''coarsest rollup table still giving at least width buckets over [t1,t2], None for raw readings'''
+        span = to_ms(t2.timestamp()) - to_ms(t1.timestamp())
+        table = None
+        for size, name in ROLLUPS:
+            if span // size < width:
+                break
+            table = name
+        return table
+
+    @staticmethod
+    def to_points(rows, columns=2):
+        '''rows of (ts_ms, value, ...) -> points array, NULL values are nan'''
+        return np.array(rows, dtype=float).reshape(-1, columns)
+
+    def get_values(self, meter_id, t1, t2, width=None):
+        '''
+        points [[ts_ms,value],] of [t1,t2] window (see to_points),
+        with width (plot pixels) long windows of one meter are read from rollups
+        as [[ts_ms,avg,min,max,last],]
+        '''
+        params = {'id': meter_id, 't1': to_ms(t1.timestamp()), 't2': to_ms(t2.timestamp())}
+        table = self.rollup_table(t1, t2, width) if width and meter_id is not None else None
         c = self.db.cursor()
-        c.execute(self.WITH_VIEW + 'SELECT dt,value FROM vals ORDER BY dt',
-            {'id': meter_id, 'd1': d1, 'd2': d2})
-        rows = c.fetchall()
-        return list(map(
-            lambda r: (datetime.strptime(r[0],'%Y-%m-%dT%H:%M:%S'),r[1])
-            , rows))
+        if table:
+            c.execute(self.ROLLUP_VALUES.format(table=table), params)
+            return self.to_points(c.fetchall(), 5)
+        c.execute(self.WITH_VIEW + 'SELECT dt,value FROM vals ORDER BY dt', params)
+        return self.to_points(c.fetchall())
+
+    def get_values_grouped(self, meter_ids, t1, t2):
+        '''points of given meters by one query {meter_id: [[ts_ms,value],]}'''
+        params = {'m%d' % i: meter_id for i, meter_id in enumerate(meter_ids)}
+        if not params:
+            return {}
+        meters = 'meters(m_id) AS (VALUES %s)' % ','.join('(:%s)' % name for name in params)
+        params.update({'t1': to_ms(t1.timestamp()), 't2': to_ms(t2.timestamp())})
+        c = self.db.cursor()
+        c.execute(self.VIEW.format(meters=meters) + 'SELECT meter_id,dt,value FROM vals ORDER BY meter_id,dt',
+            params)
+        result = {}
+        for meter_id, dt, value in c:
+            result.setdefault(meter_id, []).append((dt, value))
+        return {meter_id: self.to_points(rows) for meter_id, rows in result.items()}
+
+    def get_values_after(self, meter_id, t, t2):
+        '''points newer than t (incremental refresh)'''
+        c = self.db.cursor()
+        c.execute('''
+            SELECT ts,value FROM MeteringTs
+            WHERE meter_id = ? AND ts > ? AND ts <= ? ORDER BY ts
+            ''', (meter_id, to_ms(t.timestamp()), to_ms(t2.timestamp())))
+        return self.to_points(c.fetchall())
+
+######################################################
+## cache part
+
+class RingBuffer:
+    '''fixed size time series, the oldest points are overwritten'''
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.ts = np.zeros(capacity) # epoch ms, ascending
+        self.values = np.zeros(capacity)
+        self.start = 0
+        self.count = 0
+        self.since = None # complete history is kept from this time
+
+    def _at(self, i):
+        return (self.start + i) % self.capacity
+
+    def last_ts(self):
+        return self.ts[self._at(self.count - 1)] if self.count else None
+
+    def covers(self, t):
+        return self.since is not None and self.since <= t
+
+    def clear(self, since):
+        self.start = 0
+        self.count = 0
+        self.since = since
+
+    def append(self, ts, value):
+        if self.count < self.capacity:
+            j = self._at(self.count)
+            self.count += 1
+        else:
+            j = self.start
+            self.start = self._at(1)
+            self.since = max(self.since, self.ts[self.start])
+        self.ts[j] = ts
+        self.values[j] = value
+
+    def extend(self, points):
+        for ts, value in points[:, :2]:
+            self.append(ts, value)
+
+    def _bisect(self, t, right=False):
+        '''first index with ts >= t (or > t if right)'''
+        side = 'right' if right else 'left'
+        # both parts of the ring are ascending
+        older = self.capacity - self.start # points up to the end of arrays
+        if self.count <= older:
+            return int(np.searchsorted(self.ts[self.start:self.start + self.count], t, side))
+        i = int(np.searchsorted(self.ts[self.start:], t, side))
+        if i < older:
+            return i
+        return older + int(np.searchsorted(self.ts[:self.count - older], t, side))
+
+    def points(self, i, j):
+        '''points [[ts_ms,value],] from i-th to j-th (exclusive)'''
+        k = (self.start + np.arange(i, j)) % self.capacity
+        return np.column_stack((self.ts[k], self.values[k]))
+
+    def window(self, t1, t2):
+        '''points in [t1,t2] with the previous point clamped to t1 (as DB.WITH_VIEW)'''
+        i = self._bisect(t1)
+        j = self._bisect(t2, right=True)
+        points = self.points(i - 1 if i > 0 else i, j)
+        if i > 0:
+            points[0, 0] = t1
+        return points
+
+    def after(self, t):
+        return self.points(self._bisect(t, right=True), self.count)
+
+
+class MeterCache:
+    '''
+    Per meter ring buffers serving the live window from memory.
+    DB is read only for initial backfill and for gaps (notifications without readings).
+    '''
+
+    def __init__(self, db, window, capacity=Cfg.CACHE_POINTS):
+        self.db = db
+        self.window = window
+        self.capacity = capacity
+        self.meters = {}
+
+    def get_values(self, meter_id, t1, t2):
+        '''window points [[ts_ms,value],], backfill from DB if not in memory'''
+        buf = self.meters.get(meter_id)
+        if buf is None:
+            buf = self.meters[meter_id] = RingBuffer(self.capacity)
+        if not buf.covers(to_ms(t1.timestamp())):
+            buf.clear(to_ms(t1.timestamp()))
+            buf.extend(self.db.get_values(meter_id, t1, t2))
+        return buf.window(to_ms(t1.timestamp()), to_ms(t2.timestamp()))
+
+    def preload(self, meter_ids, t1, t2):
+        '''backfill buffers of given meters by one grouped query'''
+        grouped = self.db.get_values_grouped(meter_ids, t1, t2)
+        for meter_id in meter_ids:
+            buf = self.meters[meter_id] = RingBuffer(self.capacity)
+            buf.clear(to_ms(t1.timestamp()))
+            if meter_id in grouped:
+                buf.extend(grouped[meter_id])
+
+    def on_update(self, meter_id, readings=None):
+        '''
+        apply update notification, return new points [[ts_ms,value],]
+        readings are [[ts_ms, value, state],], None means 'read it from DB'
+        '''
+        buf = self.meters.get(meter_id)
+        if buf is None:
+            return [] # not watched
+        last = buf.last_ts()
+        if readings is None or last is None:
+            now = datetime.today()
+            t = datetime.fromtimestamp(last / 1000) if last is not None else now - self.window
+            rows = self.db.get_values_after(meter_id, t, now)
+        else:
+            rows = [(ts, v) for ts,v,*_ in readings]
+        for ts,v in rows:
+            if last is None or ts > last: # skip repeated & late readings
+                buf.append(ts, v)
+        return buf.after(last) if last is not None else buf.points(0, buf.count)
+
+######################################################
+## series helpers
+
+# x-axis is in matplotlib date numbers (days) of UTC, labels are in local time
+EPOCH_DATE_NUM = mdates.date2num(datetime(1970, 1, 1)) # of epoch 0
+LOCAL_TZ = datetime.now().astimezone().tzinfo
+MS_PER_DAY = 86400000
+
+def date_num(t):
+    '''local datetime -> matplotlib date number'''
+    return t.timestamp() * 1000 / MS_PER_DAY + EPOCH_DATE_NUM
+
+def to_date_nums(data):
+    '''points [[ts_ms,value,...],] -> (matplotlib date numbers, values) arrays'''
+    return data[:, 0] / MS_PER_DAY + EPOCH_DATE_NUM, data[:, 1]
+
+def step_series(xn, v, end):
+    '''
+    step line vertices of points, each value is held until the next point,
+    the last one until end: x0,x1,x1,x2,...,end / v0,v0,v1,v1,...,vn
+    '''
+    sx = np.empty(2 * len(xn))
+    sx[0::2] = xn
+    sx[1:-1:2] = xn[1:]
+    sx[-1] = end
+    return sx, np.repeat(v, 2)
+
+def area_verts(sx, sv):
+    '''polygon under step series'''
+    return np.column_stack((np.r_[sx[0], sx, sx[-1]], np.r_[0, sv, 0]))
+
+def setup_time_axis(ax, window):
+    '''date x-axis, ticks for live window or automatic for longer ones'''
+    ax.xaxis_date(LOCAL_TZ)
+    ax.xaxis.set_tick_params(rotation=15, labelsize=8)
+    if window <= timedelta(seconds=Cfg.LIVE_WINDOW):
+        ax.xaxis.set_major_formatter(mdates.DateFormatter('%H:%M:%S', tz=LOCAL_TZ))
+        ax.xaxis.set_major_locator(mdates.SecondLocator(bysecond=[0,15,30,45], tz=LOCAL_TZ))
+        ax.xaxis.set_minor_locator(mdates.SecondLocator(bysecond=[0,5,10,15,20,25,30,35,40,45,50,55], tz=LOCAL_TZ))
+    else:
+        locator = mdates.AutoDateLocator(tz=LOCAL_TZ)
+        ax.xaxis.set_major_locator(locator)
+        ax.xaxis.set_major_formatter(mdates.ConciseDateFormatter(locator, tz=LOCAL_TZ))
+    ax.grid(True)
+
+def axis_end(now, step):
+    '''x-axis end: the next step boundary after now'''
+    step = step.total_seconds()
+    return datetime.fromtimestamp(math.ceil(now.timestamp() / step) * step)
+
+def lttb(x, y, threshold):
+    '''Largest-Triangle-Three-Buckets downsampling, returns indices of kept points'''
+    n = len(x)
+    if threshold < 3 or n <= threshold:
+        return np.arange(n)
+
+    # first & last points are kept, the rest is split into threshold-2 buckets
+    edges = np.linspace(1, n - 1, threshold - 1).astype(int)
+    idx = np.empty(threshold, dtype=int)
+    idx[0], idx[-1] = 0, n - 1
+    a = 0
+    for i in range(threshold - 2):
+        lo, hi = edges[i], edges[i + 1]
+        nlo, nhi = (hi, edges[i + 2]) if i + 2 < len(edges) else (n - 1, n)
+        avg_x, avg_y = x[nlo:nhi].mean(), y[nlo:nhi].mean()
+
+        # point forming the largest triangle with the previous kept point & next bucket average
+        area = np.abs((x[a] - avg_x) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (avg_y - y[a]))
+        a = lo + int(np.argmax(area))
+        idx[i + 1] = a
+    return idx
 
 ######################################################
 ## GUI part
 
+class FrameStats:
+    '''times of the last frames by kind: 'full' repaint or 'blit' of animated artists'''
+
+    def __init__(self, size=Cfg.FRAME_STATS_SIZE):
+        self.times = {'full': deque(maxlen=size), 'blit': deque(maxlen=size)}
+        self.counts = {'full': 0, 'blit': 0}
+
+    def add(self, kind, sec):
+        self.times[kind].append(sec)
+        self.counts[kind] += 1
+
+    def summary(self):
+        '''{kind: {'frames', 'avg_ms', 'p50_ms', 'p95_ms', 'max_ms'}} of kept frame times'''
+        result = {}
+        for kind, times in self.times.items():
+            ms = sorted(t * 1000 for t in times)
+            result[kind] = {
+                'frames': self.counts[kind],
+                'avg_ms': sum(ms) / len(ms) if ms else 0.0,
+                'p50_ms': ms[len(ms) // 2] if ms else 0.0,
+                'p95_ms': ms[min(len(ms) - 1, len(ms) * 95 // 100)] if ms else 0.0,
+                'max_ms': ms[-1] if ms else 0.0,
+            }
+        return result
+
+    def __str__(self):
+        return '; '.join('%s: %d frames, avg %.1f ms, p50 %.1f ms, p95 %.1f ms, max %.1f ms' % (
+            kind, st['frames'], st['avg_ms'], st['p50_ms'], st['p95_ms'], st['max_ms'])
+            for kind, st in self.summary().items())
+
+
+class TimedCanvas(FigureCanvasTkAgg):
+    '''Tk canvas recording full repaint times into frame_stats'''
+
+    def __init__(self, figure, master, frame_stats):
+        self.frame_stats = frame_stats
+        FigureCanvasTkAgg.__init__(self, figure, master)
+
+    def draw(self):
+        t = time.perf_counter()
+        FigureCanvasTkAgg.draw(self)
+        self.frame_stats.add('full', time.perf_counter() - t)
+
+
 class ValuesFrame(tk.Frame):
     MIN_VALUE = 0
     MAX_VALUE = 105
+    WINDOW = timedelta(seconds=Cfg.LIVE_WINDOW)
+    DECIMATE = True # draw at most ~plot_width() points (LTTB)
+    CAPACITY = 8192 # preallocated series steps (2 per point)
+    BLIT = Cfg.BLIT
     def __init__(self, title, *args, **kwargs):
         self._title = title
+        self.WINDOW = kwargs.pop('window', self.WINDOW)
 
         tk.Frame.__init__(self, *args, **kwargs)
 
         fig, self._ax = plt.subplots()
-        self._ax.xaxis.set_tick_params(rotation=15, labelsize=8)
-        self._ax.xaxis.set_major_formatter(mdates.DateFormatter('%H:%M:%S'))
-        self._ax.xaxis.set_major_locator(mdates.SecondLocator(bysecond=[0,15,30,45]))
-        self._ax.xaxis.set_minor_locator(mdates.SecondLocator(bysecond=[0,5,10,15,20,25,30,35,40,45,50,55]))
-        self._ax.grid(True)
+        self._setup_axes()
 
-        self._canvas = FigureCanvasTkAgg(fig, self)
+        self.frame_stats = FrameStats()
+        self._canvas = TimedCanvas(fig, self, self.frame_stats)
         self._canvas.get_tk_widget().pack(side=tk.TOP, fill=tk.BOTH, expand=True)
 
+        '''blit mode: x-axis moves by whole major ticks, background is re-cached on full repaints only'''
+        self._background = None
+        self._xlim_end = None
+        self._step = timedelta(seconds=15) if self.WINDOW <= timedelta(seconds=Cfg.LIVE_WINDOW) else self.WINDOW / 8
+        if self.BLIT:
+            self._canvas.mpl_connect('draw_event', self._on_draw)
+
         self.last_line = None
         self.poly = None
+        self.last_time = None # time of the last drawn data point (epoch ms)
+        self._set_series(np.empty(0), np.empty(0))
         self.update_timeline()
     
-    def invalidate_viewport(self):
+    def _setup_axes(self):
+        '''date x-axis & grid (ax.clear() resets them)'''
+        setup_time_axis(self._ax, self.WINDOW)
+
+    def _set_series(self, sx, sv):
+        '''
+        keep step series in preallocated arrays, window is [_head:_tail],
+        times as matplotlib date numbers, the last one is extended to 'now'
+        '''
+        n = len(sx)
+        self._sx = np.empty(max(2 * n, self.CAPACITY))
+        self._sv = np.empty(len(self._sx))
+        self._sx[:n] = sx
+        self._sv[:n] = sv
+        self._head, self._tail = 0, n
+
+    def _reserve(self, extra):
+        '''room for extra steps after _tail, compact (or grow) when the arrays end'''
+        if self._tail + extra <= len(self._sx):
+            return
+        n = self._tail - self._head
+        sx, sv = self._series()
+        if n + extra > len(self._sx):
+            self._sx, self._sv = np.empty(2 * (n + extra)), np.empty(2 * (n + extra))
+        self._sx[:n], self._sv[:n] = sx.copy(), sv.copy()
+        self._head, self._tail = 0, n
+
+    def _series(self):
+        '''views of the window step series'''
+        return self._sx[self._head:self._tail], self._sv[self._head:self._tail]
+
+    def plot_width(self):
+        '''plot area width in pixels'''
+        return max(1, int(self._ax.bbox.width))
+
+    def invalidate_viewport(self, full=False):
+        '''repaint, in blit mode the whole figure only if full or time left the x-axis'''
         t2 = datetime.today()
-        t1 = t2 - timedelta(seconds=65)
-        self._ax.set_xlim([t1,t2])
-        self._ax.set_ylim([self.MIN_VALUE,self.MAX_VALUE])
-        self._canvas.draw_idle()
+        if not self.BLIT:
+            t1 = t2 - self.WINDOW
+            self._ax.set_xlim([date_num(t1), date_num(t2)])
+            self._ax.set_ylim([self.MIN_VALUE,self.MAX_VALUE])
+            self._canvas.draw_idle()
+            return
+
+        if full or self._background is None or t2 > self._xlim_end:
+            '''move x-axis to the next tick boundary'''
+            self._xlim_end = axis_end(t2, self._step)
+            self._ax.set_xlim([date_num(self._xlim_end - self.WINDOW), date_num(self._xlim_end)])
+            self._ax.set_ylim([self.MIN_VALUE,self.MAX_VALUE])
+            self._canvas.draw() # background is cached in _on_draw
+        else:
+            self._blit()
+
+    def _on_draw(self, event):
+        '''full repaint done: cache background, draw animated artists over it'''
+        self._background = self._canvas.copy_from_bbox(self._ax.bbox)
+        self._draw_animated()
+
+    def _draw_animated(self):
+        for artist in (self.poly, self.last_line):
+            if artist:
+                self._ax.draw_artist(artist)
+
+    def _blit(self):
+        t = time.perf_counter()
+        self._canvas.restore_region(self._background)
+        self._draw_animated()
+        self._canvas.blit(self._ax.bbox)
+        self.frame_stats.add('blit', time.perf_counter() - t)
 
     def update_timeline(self):
         now = datetime.today()
 
         '''extend last_line to the current time'''
         if self.last_line:
+            self._sx[self._tail - 1] = date_num(now)
             xd = self.last_line.get_xdata()
-            xd[-1] = now
+            xd[-1] = self._sx[self._tail - 1]
             self.last_line.set_xdata(xd)
 
         '''extend the poly to the current time'''
         if self.poly:
-            self.poly.xy[-3][0] = mdates.date2num(now)
-            self.poly.xy[-2][0] = mdates.date2num(now)
+            self.poly.xy[-3][0] = date_num(now)
+            self.poly.xy[-2][0] = date_num(now)
 
         self.invalidate_viewport()
         self.after(1000, self.update_timeline)
@@ -134,111 +542,302 @@ class ValuesFrame(tk.Frame):
     def draw_data(self, data):
         '''
         update frame with data
-        where data elems are points [(datetime,value),]
+        where data is points array [[ts_ms,value],]
         '''
 
-        ''''convert input data to xy arrays'''
-        tx = []
-        tv = []
-        last_v = None
-        for x,v,*_ in data:
-            if last_v != None:
-                tx.append(x)
-                tv.append(last_v)
-            tx.append(x)
-            tv.append(v)
-            last_v = v
-
-        '''append last point for the current time'''
-        if tx and tv:
-            tx.append(datetime.today())
-            tv.append(last_v)
+        '''convert input data to step series arrays'''
+        if len(data):
+            xn, v = to_date_nums(data)
+            if self.DECIMATE:
+                keep = lttb(xn, v, self.plot_width())
+                xn, v = xn[keep], v[keep]
+            sx, sv = step_series(xn, v, date_num(datetime.today()))
+        else:
+            sx = sv = np.empty(0)
 
         '''clear old plots and patches'''
         self._ax.clear()
-        self._ax.grid(True)
+        self._setup_axes()
         [p.remove() for p in reversed(self._ax.patches)]
 
-        if tx and tv:
+        '''keep series for incremental updates'''
+        self._set_series(sx, sv)
+        self.last_time = data[-1, 0] if len(data) else None
+
+        if len(sx):
             '''plot main lines'''
-            *_, self.last_line = self._ax.plot_date(tx, tv, 'r-', xdate=True, lw=3)
+            *_, self.last_line = self._ax.plot(sx, sv, 'r-', lw=3, animated=self.BLIT)
 
             '''draw transparent polygon area'''
-            verts = [
-                (mdates.date2num(tx[0]), 0), 
-                *zip(map(mdates.date2num, tx), tv), 
-                (mdates.date2num(tx[-1]), 0)
-                ]
-            self.poly = Polygon(verts, alpha=0.2, facecolor='r', edgecolor='r')
+            self.poly = Polygon(self._poly_verts(), alpha=0.2, facecolor='r', edgecolor='r', animated=self.BLIT)
             self._ax.add_patch(self.poly)
             self._ax.set_title(self._title)
         else:
+            self.last_line = None
+            self.poly = None
             self._ax.set_title('No data for ' + self._title)
 
 
+        '''update viewport'''
+        self.invalidate_viewport(full=True)
+
+    def append_data(self, data):
+        '''
+        extend frame with points newer than last_time [[ts_ms,value],],
+        drop points which left the window, nothing is re-plotted,
+        the series is updated in place (only new steps are converted)
+        '''
+        if not len(data):
+            return
+        if not self.last_line:
+            self.draw_data(data)
+            return
+
+        now = datetime.today()
+
+        ''''now' point holds the last value until the first new one, then new steps'''
+        sx, sv = step_series(*to_date_nums(data), date_num(now))
+        self._reserve(len(sx))
+        t = self._tail
+        self._sx[t - 1] = sx[0]
+        self._sx[t:t + len(sx)] = sx
+        self._sv[t:t + len(sx)] = sv
+        self._tail = t + len(sx)
+        self.last_time = data[-1, 0]
+
+        '''drop segments which are completely out of the window'''
+        t1 = date_num(now - self.WINDOW)
+        self._head += int(np.searchsorted(self._sx[self._head + 1:self._tail - 1], t1, side='right'))
+
+        self.last_line.set_data(*self._series())
+        self.poly.set_xy(self._poly_verts())
+
         '''update viewport'''
         self.invalidate_viewport()
 
-######################################################
-# main
-selected_id = int(sys.argv[1]) if len(sys.argv) > 1 else 0
+    def _poly_verts(self):
+        return area_verts(*self._series())
+
+
+class MeterPanel:
+    '''small chart of one meter on dashboard axes'''
+
+    def __init__(self, ax, meter_id, animated):
+        self.ax = ax
+        self.meter_id = meter_id
+        self.line, = ax.plot([], [], 'r-', lw=1.5, animated=animated)
+        self.poly = Polygon(np.zeros((1, 2)), alpha=0.2, facecolor='r', edgecolor='r', animated=animated)
+        ax.add_patch(self.poly)
+        ax.set_title('Meter #{}'.format(meter_id), fontsize=8)
+
+    def set_data(self, data, end):
+        '''replace series by window points [[ts_ms,value],], the last value is held until end'''
+        if not len(data):
+            self.line.set_data([], [])
+            self.poly.set_xy(np.zeros((1, 2)))
+            return
+        xn, v = to_date_nums(data)
+        if ValuesFrame.DECIMATE:
+            keep = lttb(xn, v, max(1, int(self.ax.bbox.width)))
+            xn, v = xn[keep], v[keep]
+        sx, sv = step_series(xn, v, date_num(end))
+        self.line.set_data(sx, sv)
+        self.poly.set_xy(area_verts(sx, sv))
+
+    def draw(self):
+        self.ax.draw_artist(self.poly)
+        self.ax.draw_artist(self.line)
+
+
+class DashboardFrame(tk.Frame):
+    '''
+    grid of meter panels in one figure,
+    panels are repainted only when their meters changed (blitted in blit mode),
+    the whole figure only when time crosses the x-axis end (all lines are extended to 'now' then)
+    '''
+    MIN_VALUE = ValuesFrame.MIN_VALUE
+    MAX_VALUE = ValuesFrame.MAX_VALUE
+    WINDOW = timedelta(seconds=Cfg.LIVE_WINDOW)
+    STEP = timedelta(seconds=15) # x-axis moves by major ticks
+    BLIT = Cfg.BLIT
+
+    def __init__(self, meter_ids, get_values, *args, **kwargs):
+        '''get_values(meter_id, t1, t2) returns window points of meter'''
+        self._get_values = get_values
 
-selected_id = 2 #test
+        tk.Frame.__init__(self, *args, **kwargs)
+
+        cols = max(1, math.ceil(math.sqrt(len(meter_ids))))
+        rows = max(1, math.ceil(len(meter_ids) / cols))
+        fig = plt.figure(figsize=(2.6 * cols, 1.8 * rows), constrained_layout=True)
+        axes = list(fig.subplots(rows, cols, sharex=True, sharey=True, squeeze=False).flat)
+        self.panels = {}
+        for i, meter_id in enumerate(meter_ids):
+            ax = axes[i]
+            setup_time_axis(ax, self.WINDOW)
+            ax.xaxis.set_tick_params(labelsize=6, labelbottom=i + cols >= len(meter_ids)) # the lowest in column
+            ax.yaxis.set_tick_params(labelsize=6)
+            self.panels[meter_id] = MeterPanel(ax, meter_id, self.BLIT)
+        for ax in axes[len(meter_ids):]: # the rest of the grid
+            ax.set_visible(False)
+
+        self.frame_stats = FrameStats()
+        self._canvas = TimedCanvas(fig, self, self.frame_stats)
+        self._canvas.get_tk_widget().pack(side=tk.TOP, fill=tk.BOTH, expand=True)
+
+        self._backgrounds = {} # axes -> cached background (blit mode)
+        self._xlim_end = None
+        if self.BLIT:
+            self._canvas.mpl_connect('draw_event', self._on_draw)
+        self.update_timeline()
+
+    def update_timeline(self):
+        '''repaint all panels when time crosses the x-axis end'''
+        now = datetime.today()
+        if self._xlim_end is None or now > self._xlim_end:
+            self.draw_all()
+        self.after(1000, self.update_timeline)
+
+    def draw_all(self):
+        '''refresh every panel & repaint the whole figure'''
+        now = datetime.today()
+        self._xlim_end = axis_end(now, self.STEP)
+        for panel in self.panels.values():
+            panel.set_data(self._get_values(panel.meter_id, now - self.WINDOW, now), now)
+            panel.ax.set_xlim([date_num(self._xlim_end - self.WINDOW), date_num(self._xlim_end)])
+            panel.ax.set_ylim([self.MIN_VALUE, self.MAX_VALUE])
+        self._canvas.draw()
+
+    def update_panels(self, meter_ids):
+        '''refresh panels of changed meters only'''
+        now = datetime.today()
+        panels = [self.panels[meter_id] for meter_id in meter_ids if meter_id in self.panels]
+        for panel in panels:
+            panel.set_data(self._get_values(panel.meter_id, now - self.WINDOW, now), now)
+        if not panels:
+            return
+        if not self.BLIT:
+            self._canvas.draw_idle()
+            return
+
+        t = time.perf_counter()
+        for panel in panels:
+            self._canvas.restore_region(self._backgrounds[panel.ax])
+            panel.draw()
+            self._canvas.blit(panel.ax.bbox)
+        self.frame_stats.add('blit', time.perf_counter() - t)
+
+    def _on_draw(self, event):
+        '''full repaint done: cache panel backgrounds, draw animated artists over them'''
+        for panel in self.panels.values():
+            self._backgrounds[panel.ax] = self._canvas.copy_from_bbox(panel.ax.bbox)
+            panel.draw()
 
-# create AMQP-consumer
-msg_queue = queue.Queue()
-consumer_thread = ConsumerThread(
-    msg_queue, 
-    Cfg.AMQP_HOST, 
-    Cfg.AFTER_UPD_EXCHANGE_TYPE, 
-    Cfg.AFTER_UPD_EXCHANGE_NAME,
-    Cfg.ROUTE_KEY_FACILITY + '.*'
-)
-consumer_thread.start()
+######################################################
+# main
+args = sys.argv[1:]
+dashboard = '--dashboard' in args
+if dashboard:
+    args.remove('--dashboard')
 
 # open DB
 db = DB()
 db.open()
 
+if dashboard:
+    meter_ids = [int(a) for a in args] or db.get_known_meters()[:Cfg.DASHBOARD_MAX]
+    window_sec = Cfg.LIVE_WINDOW
+else:
+    selected_id = int(args[0]) if args else next(iter(db.get_known_meters()), 0)
+    window_sec = int(args[1]) if len(args) > 1 else Cfg.LIVE_WINDOW
+live = window_sec <= Cfg.LIVE_WINDOW_MAX # else history mode, redrawn from rollups
+
+# define work data
+delta = timedelta(seconds=window_sec)
+cache = MeterCache(db, delta)
+
 # create Tk window
 root = tk.Tk()
-root.title('Meter-View')
-vf = ValuesFrame('Meter #{}'.format(selected_id), root)
-vf.pack()
-
-# define work data & procs
-delta = timedelta(seconds=65)
+if dashboard:
+    root.title('Meter-Dashboard')
+else:
+    root.title('Meter-View')
+vf = None # created after subscribing, not to miss updates
 
 def update_view():
     global selected_id, vf, delta
     now = datetime.today()
-    v = db.get_values(selected_id, now-delta, now)
+    if live:
+        v = cache.get_values(selected_id, now-delta, now)
+    else:
+        v = db.get_values(selected_id, now-delta, now, vf.plot_width())
     vf.draw_data(v)
 
-def process_queue():
-    global root, msg_queue, selected_id
-    while msg_queue.qsize():
+changed = {} # meter_id -> readings, None if any notification came without them
+
+def on_notification(jmsg):
+    '''collect notification, a burst of them is applied at once'''
+    if not changed:
+        asyncio.get_running_loop().call_soon(apply_changes)
+    for upd_id, readings, _ in meters_notify.updates(json.loads(jmsg)):
         try:
-            jmsg = msg_queue.get(0)
-            msg = json.loads(jmsg)
-            upd_id = int(msg.get('id', '0'))
+            upd_id = int(upd_id)
+        except (TypeError, ValueError):
+            continue # not a numeric id, such meters are not shown
+        if readings is None or changed.get(upd_id, []) is None:
+            changed[upd_id] = None
+        else:
+            changed[upd_id] = changed.get(upd_id, []) + readings
+
+def apply_changes():
+    '''update each changed meter (and the view) once per burst of notifications'''
+    updates = dict(changed)
+    changed.clear()
+    if dashboard:
+        for upd_id, readings in updates.items():
+            cache.on_update(upd_id, readings)
+        vf.update_panels(updates)
+    elif not live:
+        if selected_id in updates:
+            update_view() # history window is redrawn from rollups
+    else:
+        for upd_id, readings in updates.items():
+            v = cache.on_update(upd_id, readings)
             if upd_id == selected_id:
-                update_view()
-        except queue.Empty:
-            pass
-    root.after(200, process_queue)
+                vf.append_data(v)
+
+def log_frame_stats():
+    print(' [*] frame stats:', vf.frame_stats)
+    root.after(Cfg.FRAME_STATS_LOG_SEC * 1000, log_frame_stats)
+
+async def main():
+    global vf
+    # subscribe before the initial read, updates are applied only after it
+    consumer = AsyncConsumer(Cfg.AMQP_HOST) # auto-reconnect
+    await consumer.connect()
+    await consumer.subscribe(Cfg.AFTER_UPD_EXCHANGE_TYPE, Cfg.AFTER_UPD_EXCHANGE_NAME,
+        Cfg.ROUTE_KEY_FACILITY + '.*', callback=on_notification)
+
+    # init graph & timer loop
+    if dashboard:
+        now = datetime.today()
+        cache.preload(meter_ids, now-delta, now) # one grouped query for all panels
+        vf = DashboardFrame(meter_ids, cache.get_values, root)
+        vf.pack(fill=tk.BOTH, expand=True) # dashboard draws itself
+    else:
+        vf = ValuesFrame('Meter #{}'.format(selected_id), root, window=delta)
+        vf.pack()
+        update_view()
+    if Cfg.FRAME_STATS_LOG_SEC:
+        root.after(Cfg.FRAME_STATS_LOG_SEC * 1000, log_frame_stats)
 
-# init graph & timer loop
-update_view()
-process_queue()
+    await tk_mainloop(root) # Tk events & AMQP messages on one loop
 
-# run Tk mainloop
-root.protocol('WM_DELETE_WINDOW', lambda: root.quit())
-tk.mainloop()
+    #stop
+    await consumer.close()
+    print(' [*] frame stats:', vf.frame_stats)
 
-#stop
-consumer_thread.stop() # set stop-flag
+asyncio.run(main())
 
 #cleanup
 db.close()
-consumer_thread.join() # wait exit
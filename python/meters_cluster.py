@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+'''
+Meters server cluster: N consumer processes + one dedicated db writer.
+
+Consumers decode & validate meters messages (CPU side, scales across cores)
+and forward rows in batches to the single writer process, so SQLite has no
+write lock contention. Writer does group commits and sends confirmations
+back to the consumer that owns the delivery tags; the consumer then acks
+(or nacks for requeue) the whole batch and publishes update notifications.
+Consumers are MetersServer workers (queue, exchanges, decoding, acks &
+coalesced notifications as configured in meters_srv Cfg) which forward
+their batches instead of writing them.
+Usage:
+    python ./meters_cluster.py [<consumers>]
+'''
+
+import multiprocessing as mp
+import os
+import queue
+import signal
+import sqlite3
+import sys
+import time
+from meters_srv import MetersServer
+from config import Config
+
+######################################################
+## params
+
+class Cfg:
+    AMQP_HOST = Config.AMQP_HOST
+    BATCH_SIZE = 200 # max rows per consumer batch
+    BATCH_TIMEOUT_MS = 50 # max delay before forwarding incomplete batch
+    PREFETCH = 4 * BATCH_SIZE # keep several batches in flight per consumer
+    GROUP_ROWS = 5000 # max rows per writer transaction
+    GROUP_TIMEOUT_MS = 20 # max delay to collect more batches into one commit
+    STOP_TIMEOUT = 5 # sec to wait for in-flight batches on stop
+
+######################################################
+## db writer process
+
+def writer_proc(rows_queue, acks_queues):
+    '''
+    Single SQLite writer.
+    rows_queue items: (consumer_index, last_tag, rows), None to stop.
+    Confirmation (last_tag, ok) goes to acks_queues[consumer_index].
+    '''
+    from meters_db import open_db, INSERT_SQL
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # stopped by supervisor
+
+    db = open_db()
+    stopping = False
+    while not stopping:
+        group = [rows_queue.get()]
+        deadline = time.time() + Cfg.GROUP_TIMEOUT_MS / 1000
+        count = len(group[0][2]) if group[0] else 0
+        while count < Cfg.GROUP_ROWS:
+            try:
+                item = rows_queue.get(timeout=max(0, deadline - time.time()))
+            except queue.Empty:
+                break
+            group.append(item)
+            count += len(item[2]) if item else 0
+
+        if None in group:
+            stopping = True
+            group = [item for item in group if item]
+        if not group:
+            continue
+
+        ok = True
+        try:
+            db.executemany(INSERT_SQL, (row for _, _, rows in group for row in rows))
+            db.commit()
+        except sqlite3.Error as e:
+            print('sqlite3.Error:', e)
+            db.rollback()
+            ok = False
+
+        for index, last_tag, _ in group:
+            acks_queues[index].put((last_tag, ok))
+
+    db.close()
+
+######################################################
+## consumer process
+
+class ClusterConsumer(MetersServer):
+    '''
+    MetersServer in batch mode whose batches are written by the writer
+    process. Confirmations are picked up between messages (at least every
+    meters_srv Cfg.TICK), then MetersServer acks the batch and reports it
+    (coalesced notifications).
+    '''
+
+    BATCH_SIZE = Cfg.BATCH_SIZE
+    BATCH_TIMEOUT_MS = Cfg.BATCH_TIMEOUT_MS
+    BATCH_PREFETCH = Cfg.PREFETCH
+
+    def __init__(self, index, rows_queue, acks_queue):
+        super(ClusterConsumer, self).__init__(Cfg.AMQP_HOST, batch=True)
+        self.index = index
+        self.rows_queue = rows_queue
+        self.acks_queue = acks_queue
+        self.in_flight = {} # last_tag -> rows forwarded to writer
+
+    def setup(self):
+        pass # writer owns the db
+
+    def flush_batch(self):
+        '''forward pending batch to writer'''
+        self.batch_due = None
+        if self.last_tag is None:
+            return
+        self.in_flight[self.last_tag] = self.rows
+        self.rows_queue.put((self.index, self.last_tag, self.rows))
+        self.rows, self.last_tag = [], None
+
+    def on_timers(self):
+        self.take_confirmations()
+        super(ClusterConsumer, self).on_timers()
+
+    def take_confirmations(self, timeout=0):
+        '''handle writer confirmations, wait up to timeout for the first one'''
+        try:
+            item = self.acks_queue.get(timeout=timeout) if timeout > 0 else self.acks_queue.get_nowait()
+            while True:
+                last_tag, ok = item
+                self.on_written(self.in_flight.pop(last_tag), last_tag, ok)
+                item = self.acks_queue.get_nowait()
+        except queue.Empty:
+            pass
+
+    def cleanup(self):
+        # wait the writer for what is already received
+        self.flush_batch()
+        deadline = time.time() + Cfg.STOP_TIMEOUT
+        while self.in_flight and time.time() < deadline:
+            self.take_confirmations(deadline - time.time())
+        super(ClusterConsumer, self).cleanup()
+
+def consumer_proc(index, rows_queue, acks_queue):
+    '''decode meters messages, forward rows to writer, ack on confirmation'''
+    server = ClusterConsumer(index, rows_queue, acks_queue)
+    signal.signal(signal.SIGINT, lambda signum, frame: server.stop()) # gracefully stopping
+
+    print(' [*] Consumer #%d (pid %d) started.' % (index, os.getpid()))
+    server.run()
+    print(' [*] Consumer #%d stopped.' % index)
+
+######################################################
+# main
+
+if __name__ == '__main__':
+    consumers_count = int(sys.argv[1]) if len(sys.argv) > 1 else os.cpu_count()
+
+    rows_queue = mp.Queue()
+    acks_queues = [mp.Queue() for _ in range(consumers_count)]
+
+    # CTRL+C reaches all processes of the group, consumers stop by themselves
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    writer = mp.Process(target=writer_proc, args=(rows_queue, acks_queues), name='meters-writer')
+    writer.start()
+    consumers = [
+        mp.Process(target=consumer_proc, args=(i, rows_queue, acks_queues[i]), name='meters-consumer-%d' % i)
+        for i in range(consumers_count)
+    ]
+    for p in consumers:
+        p.start()
+
+    print(' [*] Cluster started: %d consumers, 1 writer. To exit press CTRL+C' % consumers_count)
+
+    for p in consumers:
+        p.join()
+
+    rows_queue.put(None) # stop writer after the last batch
+    writer.join()
+
+    print(' [*] Cluster stopped.')
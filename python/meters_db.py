@@ -0,0 +1,88 @@
+'''
+Meters storage schema (shared by meters_srv, meter_view & tools).
+
+Readings live in MeteringTs clustered by (meter_id, ts) where ts is integer
+epoch milliseconds, so per meter time range reads are index seeks.
+Legacy Metering table (TEXT datetime) is converted by meters_migrate.py.
+
+Rollup tables keep min/max/sum/count/last per 1 s, 1 min and 1 h buckets.
+They are maintained incrementally by insert trigger, so every writer
+(meters_srv, meters_cluster, migration) keeps them up to date, and long
+time ranges are read from buckets instead of raw readings.
+'''
+
+import sqlite3
+
+######################################################
+## schema
+
+DB_PATH = './storage.sqlite_db'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS MeteringTs (
+       meter_id INTEGER NOT NULL,
+       ts INTEGER NOT NULL, -- epoch milliseconds
+       value REAL,
+       state INTEGER,
+       PRIMARY KEY (meter_id, ts)
+) WITHOUT ROWID;
+'''
+
+# (bucket size ms, table), finest first
+ROLLUPS = (
+    (1000, 'MeteringRollup1s'),
+    (60 * 1000, 'MeteringRollup1m'),
+    (60 * 60 * 1000, 'MeteringRollup1h'),
+)
+
+ROLLUP_TABLE = '''
+CREATE TABLE IF NOT EXISTS {table} (
+       meter_id INTEGER NOT NULL,
+       bucket INTEGER NOT NULL, -- bucket start, epoch milliseconds
+       v_min REAL NOT NULL,
+       v_max REAL NOT NULL,
+       v_sum REAL NOT NULL, -- avg is v_sum / n
+       n INTEGER NOT NULL,
+       v_last REAL NOT NULL,
+       last_ts INTEGER NOT NULL, -- ts of v_last
+       PRIMARY KEY (meter_id, bucket)
+) WITHOUT ROWID;
+'''
+
+# upsert of one reading into its bucket (late readings do not move v_last),
+# fired for new readings only, repeated ones are not inserted (see INSERT_SQL)
+ROLLUP_UPSERT = '''
+    INSERT INTO {table} (meter_id,bucket,v_min,v_max,v_sum,n,v_last,last_ts)
+    VALUES (NEW.meter_id, NEW.ts - NEW.ts % {size}, NEW.value, NEW.value, NEW.value, 1, NEW.value, NEW.ts)
+    ON CONFLICT (meter_id, bucket) DO UPDATE SET
+        v_min = min(v_min, excluded.v_min),
+        v_max = max(v_max, excluded.v_max),
+        v_sum = v_sum + excluded.v_sum,
+        n = n + 1,
+        v_last = CASE WHEN excluded.last_ts >= last_ts THEN excluded.v_last ELSE v_last END,
+        last_ts = max(last_ts, excluded.last_ts);
+'''
+
+SCHEMA += ''.join(ROLLUP_TABLE.format(table=table) for _, table in ROLLUPS) + '''
+CREATE TRIGGER IF NOT EXISTS MeteringTs_rollup AFTER INSERT ON MeteringTs
+WHEN NEW.value IS NOT NULL
+BEGIN''' + ''.join(ROLLUP_UPSERT.format(table=table, size=size) for size, table in ROLLUPS) + '''
+END;
+'''
+
+# same meter & same millisecond is the same reading
+# redelivery after a crash between commit & ack is normal, the repeated reading
+# is skipped so it does not reach the rollup trigger (counted once)
+INSERT_SQL = '''INSERT INTO MeteringTs (meter_id,ts,value,state) VALUES(?,?,?,?)
+    ON CONFLICT (meter_id, ts) DO NOTHING'''
+
+def to_ms(timestamp):
+    '''epoch seconds (float) -> epoch milliseconds (int)'''
+    return int(round(timestamp * 1000))
+
+def open_db(path=DB_PATH):
+    '''connect to db and create tables if needed'''
+    db = sqlite3.connect(path)
+    db.executescript(SCHEMA)
+    db.commit()
+    return db
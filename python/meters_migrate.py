@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+'''
+Migrates legacy Metering table (TEXT local datetime) into MeteringTs (epoch ms).
+
+Works online: rows are copied in chunks by rowid with one short transaction
+per chunk, so meters_srv keeps writing into MeteringTs meanwhile.
+Progress is kept in MeteringMigration table, an interrupted run resumes
+where it stopped. Legacy datetimes have one second resolution, readings
+of a meter within one second are kept apart by millisecond offsets in
+their arrival (id) order. Rows which can not be copied (unparsable datetime,
+key taken by a reading meters_srv stored meanwhile) are counted and
+reported as skipped. Copied rows get into rollup tables by insert trigger.
+Usage:
+    python ./meters_migrate.py [--chunk <rows>] [--drop] [--rollups]
+
+    --chunk   rows per transaction (default Cfg.CHUNK_ROWS)
+    --drop    drop legacy table when all rows are copied
+    --rollups rebuild rollup tables from MeteringTs (for readings stored
+              before rollups existed), one transaction per meter
+'''
+
+import sys
+import time
+import sqlite3
+from meters_db import open_db, ROLLUPS
+
+######################################################
+## params
+
+class Cfg:
+    CHUNK_ROWS = 50000
+    PAUSE_SEC = 0.05 # let writers grab the db lock between chunks
+
+######################################################
+## migration
+
+# Legacy datetimes are whole seconds, so readings of one meter within a second
+# share the key. They are spread over the milliseconds of their second in id
+# (arrival) order: n-th reading of the second in the chunk gets
+# sec * 1000 + n + <rows of the second already in MeteringTs>, the latter
+# continues a second split between chunks. Unparsable datetime gives NULL ts.
+COPY_CHUNK_SQL = '''
+    INSERT OR IGNORE INTO MeteringTs (meter_id,ts,value,state)
+    SELECT meter_id,
+        sec * 1000 + nth + (SELECT count(*) FROM MeteringTs
+            WHERE meter_id = c.meter_id AND ts BETWEEN c.sec * 1000 AND c.sec * 1000 + 999),
+        value, [state]
+    FROM (
+        SELECT meter_id, CAST(strftime('%s', [datetime], 'utc') AS INTEGER) AS sec, value, [state],
+            row_number() OVER (PARTITION BY meter_id, [datetime] ORDER BY id) - 1 AS nth
+        FROM Metering
+        WHERE id > :lo AND id <= :hi
+    ) AS c
+'''
+
+CHUNK_ROWS_SQL = 'SELECT count(*) FROM Metering WHERE id > :lo AND id <= :hi'
+
+# v_last is the value of the latest reading of the bucket
+REBUILD_ROLLUP_SQL = '''
+    INSERT OR REPLACE INTO {table} (meter_id,bucket,v_min,v_max,v_sum,n,v_last,last_ts)
+    SELECT meter_id, bucket, v_min, v_max, v_sum, n,
+        (SELECT value FROM MeteringTs WHERE meter_id = b.meter_id AND ts = b.last_ts), last_ts
+    FROM (
+        SELECT meter_id, ts - ts % {size} AS bucket, min(value) AS v_min, max(value) AS v_max,
+            sum(value) AS v_sum, count(*) AS n, max(ts) AS last_ts
+        FROM MeteringTs
+        WHERE meter_id = :id AND value IS NOT NULL
+        GROUP BY bucket
+    ) AS b
+'''
+
+NEXT_METER_SQL = 'SELECT min(meter_id) FROM MeteringTs WHERE meter_id > ?'
+
+def has_table(db, name):
+    c = db.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (name,))
+    return c.fetchone() is not None
+
+def migrate(db, chunk_rows):
+    '''copy Metering into MeteringTs chunk by chunk, return (copied, skipped) rows count'''
+    db.execute('CREATE TABLE IF NOT EXISTS MeteringMigration (last_id INTEGER NOT NULL)')
+    row = db.execute('SELECT last_id FROM MeteringMigration').fetchone()
+    if row is None:
+        db.execute('INSERT INTO MeteringMigration (last_id) VALUES (0)')
+        db.commit()
+        last_id = 0
+    else:
+        last_id = row[0]
+
+    max_id = db.execute('SELECT max(id) FROM Metering').fetchone()[0] or 0
+    copied = skipped = 0
+    started = time.time()
+
+    while last_id < max_id:
+        hi = min(last_id + chunk_rows, max_id)
+        params = {'lo': last_id, 'hi': hi}
+        rows = db.execute(CHUNK_ROWS_SQL, params).fetchone()[0]
+        c = db.execute(COPY_CHUNK_SQL, params)
+        db.execute('UPDATE MeteringMigration SET last_id = ?', (hi,))
+        db.commit()
+
+        copied += c.rowcount
+        skipped += rows - c.rowcount
+        last_id = hi
+        print(' [x] rows up to id %d of %d, copied %d, skipped %d (%.1f s)' % (
+            last_id, max_id, copied, skipped, time.time() - started))
+        time.sleep(Cfg.PAUSE_SEC)
+
+    return copied, skipped
+
+def rebuild_rollups(db):
+    '''recalculate rollup buckets meter by meter, return meters count'''
+    meters = 0
+    started = time.time()
+    meter_id = db.execute('SELECT min(meter_id) FROM MeteringTs').fetchone()[0]
+    while meter_id is not None:
+        for size, table in ROLLUPS:
+            db.execute(REBUILD_ROLLUP_SQL.format(table=table, size=size), {'id': meter_id})
+        db.commit()
+
+        meters += 1
+        print(' [x] rollups of meter %d rebuilt (%.1f s)' % (meter_id, time.time() - started))
+        time.sleep(Cfg.PAUSE_SEC)
+        meter_id = db.execute(NEXT_METER_SQL, (meter_id,)).fetchone()[0]
+
+    return meters
+
+######################################################
+# main
+
+chunk_rows = Cfg.CHUNK_ROWS
+if '--chunk' in sys.argv:
+    chunk_rows = int(sys.argv[sys.argv.index('--chunk') + 1])
+drop_legacy = '--drop' in sys.argv
+with_rollups = '--rollups' in sys.argv
+
+db = open_db()
+
+if not has_table(db, 'Metering'):
+    print(' [*] No legacy Metering table. Nothing to migrate.')
+else:
+    try:
+        copied, skipped = migrate(db, chunk_rows)
+        print(' [*] Migration done, %d rows copied.' % copied)
+        if skipped:
+            print(' [!] %d rows skipped (bad datetime or key taken by a newer reading).' % skipped)
+        if drop_legacy:
+            db.executescript('DROP TABLE Metering; DROP TABLE MeteringMigration;')
+            db.commit()
+            print(' [*] Legacy table dropped.')
+    except sqlite3.Error as e:
+        print('sqlite3.Error:', e, '- run again to resume.')
+
+if with_rollups:
+    try:
+        meters = rebuild_rollups(db)
+        print(' [*] Rollups rebuilt for %d meters.' % meters)
+    except sqlite3.Error as e:
+        print('sqlite3.Error:', e)
+
+db.close()
@@ -0,0 +1,47 @@
+'''
+meters_db_updates notification format (shared by meters_srv & its listeners).
+
+Single meter:
+    {'id': meter_id, 'ins_ts': t[, 'readings': [[ts_ms, value, state],]]}
+Coalesced (many meters over a time window):
+    {'ids': [meter_id,], 'ins_ts': {meter_id: t}[, 'readings': {meter_id: [[ts_ms, value, state],]}]}
+
+'ins_ts' is commit time (epoch sec), 'readings' are present if the server
+runs with values in notifications.
+'''
+
+import time
+
+ROUTE_KEY_MANY = 'many' # routing key suffix of coalesced notification
+
+def single(meter_id, rows, with_values, ins_ts=None):
+    '''notification about MeteringTs rows of one meter'''
+    msg = {'id': meter_id, 'ins_ts': ins_ts or time.time()}
+    if with_values:
+        msg['readings'] = [[ts, value, state] for _, ts, value, state in rows]
+    return msg
+
+def coalesced(meter_rows, with_values):
+    '''notification about many meters, meter_rows is {meter_id: (ins_ts, rows)}'''
+    msg = {'ids': list(meter_rows), 'ins_ts': {meter_id: t for meter_id, (t, _) in meter_rows.items()}}
+    if with_values:
+        msg['readings'] = {meter_id: [[ts, value, state] for _, ts, value, state in rows]
+            for meter_id, (_, rows) in meter_rows.items()}
+    return msg
+
+def group_rows(rows):
+    '''{meter_id: [row,]} keeping order'''
+    meter_rows = {}
+    for row in rows:
+        meter_rows.setdefault(row[0], []).append(row)
+    return meter_rows
+
+def updates(msg):
+    '''yields (meter_id, readings or None, ins_ts or None) of any notification format'''
+    if 'ids' in msg:
+        readings = msg.get('readings', {})
+        ins_ts = msg.get('ins_ts', {})
+        for meter_id in msg['ids']:
+            yield meter_id, readings.get(meter_id), ins_ts.get(meter_id)
+    else:
+        yield msg.get('id'), msg.get('readings'), msg.get('ins_ts')
@@ -1,15 +1,32 @@
 #!/usr/bin/env python3
 '''
-Meters server-worker (for horizontal scaling run multiple instances).
+Meters server-worker (for horizontal scaling run multiple instances,
+with SQLite prefer meters_cluster.py - many consumers & single db writer).
 
 Consumes messages from meters (AMQP-exchange) and insert it into db.
+Usage:
+    python ./meters_srv.py [--batch]
+
+With --batch the worker raises prefetch and collects readings until
+Cfg.BATCH_SIZE messages or Cfg.BATCH_TIMEOUT_MS elapsed, then writes them
+in one transaction and acks the whole batch with a single multiple-ack.
+
+The worker runs on amqp.transport (work queue & Producer), so MetersServer
+can also be started in-process next to emulators & viewers with 'inproc'
+host (see meter_swarm --local).
 '''
 
-import pika
 import sqlite3
 import json
 import signal
+import sys
+import threading
 import time
+from amqp.codec import get_codec
+from amqp.producer import Producer
+from amqp.transport import get_transport
+from meters_db import open_db, to_ms, INSERT_SQL, DB_PATH
+import meters_notify
 from config import Config
 
 ######################################################
@@ -23,103 +40,249 @@ class Cfg:
     WORKERS_QUEUE = 'meters_db_queue'
     AFTER_UPD_EXCHANGE_TYPE = 'topic'
     AFTER_UPD_EXCHANGE_NAME = 'meters_db_updates'
+    NOTIFY_WITH_VALUES = True # put inserted readings into update notifications
+    NOTIFY_COALESCE_MS = 200 # merge notifications per meter over this window, 0 - publish at once
+    BATCH_SIZE = 500 # max readings per transaction
+    BATCH_TIMEOUT_MS = 200 # max delay before flushing incomplete batch
+    BATCH_PREFETCH = 2 * BATCH_SIZE # keep next batch in flight while committing
+    TICK = 0.05 # sec, timers resolution (consume inactivity timeout)
 
 ######################################################
-# main
+## worker
 
 # DB part - connect to db and create tables if needed
 # Sqlite3 is just for demo. You must use a real database server for real tasks.
 # Do not overload the demo script.
 # Sqlite can handle about 4-5 concurrency inserts per second.
+# Use --batch mode to group many inserts per commit (one fsync per batch).
+
+def to_row(meter_id, timestamp, value, state):
+    '''convert reading into MeteringTs row
+    Meter id must be str, it becomes a part of notification routing key.
+    '''
+    if not isinstance(meter_id, str):
+        raise TypeError('meter id %r is not a string' % (meter_id,))
+    return (meter_id, to_ms(timestamp), value, state)
 
-#db = sqlite3.connect(':memory:')
-db = sqlite3.connect('./storage.sqlite_db')
-cursor = db.cursor()
-cursor.executescript('''
-CREATE TABLE IF NOT EXISTS Metering (
-       id INTEGER PRIMARY KEY,
-       meter_id INTEGER NOT NULL,
-       datetime TEXT,
-       value REAL,
-       state INTEGER
-);
-''')
-db.commit()
-
-def on_message(meter_id, timestamp, value, state):
-    '''Messages handler.
-    Handles new message and return True if it decide to update DB
-    :rtype: bool
+class MetersServer(threading.Thread):
+    '''
+    Consumes readings from the workers queue, inserts them into db and
+    reports updates to AFTER_UPD_EXCHANGE_NAME.
+    Run it as a thread (start/stop/join) or call run() from the main thread.
+    Batch & coalescing timers are checked between messages, so consuming,
+    db writes, acks & notifications all happen on the one thread.
+    Subclasses may write batches elsewhere (see meters_cluster): override
+    flush_batch() and report the result by on_written().
     '''
 
-    t = time.localtime(timestamp)
-    dt = time.strftime('%Y-%m-%dT%H:%M:%S', t)
-    
-    cursor.execute('''
-            INSERT INTO Metering (meter_id,datetime,value,state) VALUES(?,?,?,?) 
-        ''', (meter_id, dt, value, state))
-    db.commit()
+    BATCH_SIZE = Cfg.BATCH_SIZE
+    BATCH_TIMEOUT_MS = Cfg.BATCH_TIMEOUT_MS
+    BATCH_PREFETCH = Cfg.BATCH_PREFETCH
+
+    def __init__(self, host=Cfg.AMQP_HOST, db_path=DB_PATH, batch=False, transport=None):
+        super(MetersServer, self).__init__()
+        self._is_interrupted = False
+        self.db_path = db_path
+        self.batch = batch
+        transport = transport or get_transport(host)
+        # bind before readings are published
+        self.work_queue = transport.work_queue(Cfg.EXCHANGE_TYPE, Cfg.EXCHANGE_NAME, Cfg.WORKERS_QUEUE,
+            Cfg.ROUTE_KEY_FACILITY + '.#',
+            prefetch=self.BATCH_PREFETCH if batch else 1) #enable long ops workers selecting in round robin
+        # exchange for quick reports to all interested
+        self.notifier = Producer(host, Cfg.AFTER_UPD_EXCHANGE_TYPE, Cfg.AFTER_UPD_EXCHANGE_NAME,
+            transport=transport)
+        self.db = None
+
+        self.rows = [] # pending MeteringTs rows of the batch
+        self.last_tag = None # highest delivery tag in the batch
+        self.batch_due = None # flush time of incomplete batch
+        self.meter_rows = {} # meter_id -> (first ins_ts, rows) within coalescing window
+        self.notify_due = None # publish time of coalesced notification
+
+    def stop(self):
+        '''(thread-safe) set stop-flag'''
+        self._is_interrupted = True
+        self.work_queue.wakeup()
+
+    def run(self):
+        '''consume until stop()'''
+        self.setup()
+
+        for message in self.work_queue.consume(inactivity_timeout=Cfg.TICK):
+            if message:
+                if self.batch:
+                    self.on_batch_message(*message)
+                else:
+                    self.on_message(*message)
+            else:
+                self.notifier.process_data_events() # heartbeats of idle publisher
+            self.on_timers()
+            if self._is_interrupted:
+                break
+
+        self.cleanup()
+
+    def setup(self):
+        self.db = open_db(self.db_path)
+
+    def cleanup(self):
+        '''finish what is already received & close'''
+        if self.batch:
+            self.flush_batch() # commit & ack what is already received
+        self.flush_updates()
+
+        self.work_queue.close()
+        self.notifier.close()
+        if self.db is not None:
+            self.db.close()
+
+    def on_timers(self):
+        now = time.time()
+        if self.batch_due is not None and now >= self.batch_due:
+            self.flush_batch()
+        if self.notify_due is not None and now >= self.notify_due:
+            self.flush_updates()
 
-    # in this simple scenario the database is always updated
-    return True
+    def decode_reading(self, properties, body, delivery_tag):
+        '''decode reading by message content_type (JSON if not set)
+        Rejects undecodable or incomplete message and returns None.
+        '''
+        try:
+            msg = get_codec(getattr(properties, 'content_type', None)).decode(body)
+            to_row(msg['id'], msg['ts'], msg['value'], msg['state']) # all fields present, ts is a number
+            return msg
+        except (ValueError, KeyError, TypeError) as e:
+            print('Bad message:', e)
+            # drop it, requeue will not help
+            self.work_queue.nack(delivery_tag, requeue=False)
+            return None
 
-# RabbitMQ part - create consumer worker
-connection = pika.BlockingConnection(pika.ConnectionParameters(host=Cfg.AMQP_HOST))
-channel = connection.channel()
-channel.exchange_declare(exchange=Cfg.EXCHANGE_NAME, exchange_type=Cfg.EXCHANGE_TYPE)
-channel.queue_declare(Cfg.WORKERS_QUEUE, durable=True)
-channel.queue_bind(exchange=Cfg.EXCHANGE_NAME, queue=Cfg.WORKERS_QUEUE,
-    routing_key=Cfg.ROUTE_KEY_FACILITY + '.#')
+    def on_message(self, body, properties, delivery_tag):
+        '''consumer callback'''
+        print(" [x] %r" % (body,))
 
-# declare exchange for quick reports to all interested
-channel.exchange_declare(exchange=Cfg.AFTER_UPD_EXCHANGE_NAME, exchange_type=Cfg.AFTER_UPD_EXCHANGE_TYPE)
+        #extract message
+        msg = self.decode_reading(properties, body, delivery_tag)
+        if msg is None:
+            return
+        meter_id = msg['id']
 
-print(' [*] Worker started. Waiting for meters messages. To exit press CTRL+C')
+        try:
 
+            #handle message
+            row = to_row(meter_id, msg['ts'], msg['value'], msg['state'])
+            self.db.execute(INSERT_SQL, row)
+            self.db.commit()
 
-def callback(ch, method, properties, body):
-    '''consumer callback'''
-    print(" [x] %r:%r" % (method.routing_key, body))
+            # in this simple scenario the database is always updated
+            self.report_update(meter_id, [row])
 
-    #extract message
-    jmsg = body.decode("utf8")
-    msg = json.loads(jmsg)
-    meter_id = msg['id']
+            # ACK for meter's message
+            self.work_queue.ack(delivery_tag)
 
-    try:
+        except sqlite3.Error as e:
+            print('sqlite3.Error:', e)
+            # NAK - return message to original queue
+            self.work_queue.nack(delivery_tag, requeue=True)
 
-        #handle message
-        if on_message(meter_id, msg['ts'], msg['value'], msg['state']):
+    ######################################################
+    # batch mode - one transaction & one multiple-ack per batch
 
-            #report about DB update
-            channel.basic_publish(
-                exchange = Cfg.AFTER_UPD_EXCHANGE_NAME,
-                routing_key = Cfg.ROUTE_KEY_FACILITY + '.' + meter_id,
-                body = bytes(json.dumps({'id':meter_id}), "utf8")
-            )
+    def on_batch_message(self, body, properties, delivery_tag):
+        '''consumer callback (batch mode)'''
 
-        # ACK for meter's message
-        ch.basic_ack(delivery_tag=method.delivery_tag)
+        #extract message
+        msg = self.decode_reading(properties, body, delivery_tag)
+        if msg is None:
+            return
 
-    except sqlite3.Error as e:
-        print('sqlite3.Error:', e)
-        # NAK - return message to original queue
-        ch.basic_nack(delivery_tag=method.delivery_tag, requeue=True)
+        self.rows.append(to_row(msg['id'], msg['ts'], msg['value'], msg['state']))
+        self.last_tag = delivery_tag
+
+        if len(self.rows) >= self.BATCH_SIZE:
+            self.flush_batch()
+        elif self.batch_due is None:
+            self.batch_due = time.time() + self.BATCH_TIMEOUT_MS / 1000
+
+    def flush_batch(self):
+        '''write pending batch in one transaction and ack/nack it as a whole'''
+        self.batch_due = None
+        if self.last_tag is None:
+            return
+
+        rows, last_tag = self.rows, self.last_tag
+        self.rows, self.last_tag = [], None
+
+        ok = True
+        try:
+            self.db.executemany(INSERT_SQL, rows)
+            self.db.commit()
+        except sqlite3.Error as e:
+            print('sqlite3.Error:', e)
+            self.db.rollback()
+            ok = False
+        self.on_written(rows, last_tag, ok)
+
+    def on_written(self, rows, last_tag, ok):
+        '''ack & report the written batch, or return it to the queue'''
+        if not ok:
+            # NAK - return the whole batch to original queue
+            self.work_queue.nack(last_tag, multiple=True, requeue=True)
+            return
+
+        # report each meter once with all its rows, keep order
+        for meter_id, rows in meters_notify.group_rows(rows).items():
+            self.report_update(meter_id, rows)
+
+        # ACK for all meter's messages up to last_tag
+        self.work_queue.ack(last_tag, multiple=True)
+
+    ######################################################
+    # update notifications
+
+    def publish_update(self, meter_id, msg):
+        self.notifier.publish(json.dumps(msg), Cfg.ROUTE_KEY_FACILITY + '.' + meter_id)
+
+    def report_update(self, meter_id, rows):
+        '''report about DB update (see meters_notify for format)'''
+        if not Cfg.NOTIFY_COALESCE_MS:
+            self.publish_update(meter_id, meters_notify.single(meter_id, rows, Cfg.NOTIFY_WITH_VALUES))
+            return
+
+        ins_ts, meter_rows = self.meter_rows.get(meter_id, (time.time(), []))
+        self.meter_rows[meter_id] = (ins_ts, meter_rows + rows)
+        if self.notify_due is None:
+            self.notify_due = time.time() + Cfg.NOTIFY_COALESCE_MS / 1000
+
+    def flush_updates(self):
+        '''publish one notification for all meters updated within the window'''
+        self.notify_due = None
+        meter_rows, self.meter_rows = self.meter_rows, {}
+        if len(meter_rows) == 1:
+            [(meter_id, (ins_ts, rows))] = meter_rows.items()
+            self.publish_update(meter_id, meters_notify.single(meter_id, rows, Cfg.NOTIFY_WITH_VALUES, ins_ts))
+        elif meter_rows:
+            self.publish_update(meters_notify.ROUTE_KEY_MANY, meters_notify.coalesced(meter_rows, Cfg.NOTIFY_WITH_VALUES))
+
+######################################################
+# main
 
+if __name__ == '__main__':
+    batch = '--batch' in sys.argv[1:]
+    #server = MetersServer(db_path=':memory:', batch=batch)
+    server = MetersServer(batch=batch)
 
-channel.basic_qos(prefetch_count=1) #enable long ops workers selecting in round robin
-channel.basic_consume(queue=Cfg.WORKERS_QUEUE, on_message_callback=callback)
+    def sigint_handler(signum, frame):
+        server.stop() # gracefully stopping
 
-def sigint_handler(signum, frame):
-    channel.stop_consuming() # gracefully stopping
- 
-signal.signal(signal.SIGINT, sigint_handler)
+    signal.signal(signal.SIGINT, sigint_handler)
 
-#run worker
-channel.start_consuming()
+    print(' [*] Worker started. Waiting for meters messages. To exit press CTRL+C')
+    if batch:
+        print(' [*] Batch mode: size %d, timeout %d ms' % (Cfg.BATCH_SIZE, Cfg.BATCH_TIMEOUT_MS))
 
-print(' [*] Worker stopped.')
+    #run worker
+    server.run()
 
-#cleanup
-connection.close() # close pika connection
-db.close() # close db connection
+    print(' [*] Worker stopped.')
@@ -1,12 +1,27 @@
 #!/usr/bin/env python3
 '''
+Products catalog client.
+
+Every change of Products gets a version from ProductsLog change feed (one
+entry per product id, deletes are kept as tombstones). Clients broadcast
+{"version": v} on products_update and others fetch only rows changed
+since the version they have already seen.
+Usage:
+    python ./product_client.py [--virtual]
+
+    --virtual  list loads only visible rows & prefetch margin (keyset pages
+               on (name, id)) and pages in more on scroll
 '''
 import tkinter as tk
 from tkinter import ttk
 import sqlite3
-import queue
-from amqp.producer import Producer
-from amqp.consumer_thread import ConsumerThread
+import sys
+import json
+import asyncio
+from bisect import bisect_left
+from collections import namedtuple, OrderedDict
+from amqp.async_consumer import AsyncConsumer
+from tk_async import tk_mainloop
 from config import Config
 
 ######################################################
@@ -16,6 +31,11 @@ class Cfg:
     AMQP_HOST = Config.AMQP_HOST
     EXCHANGE_TYPE = 'fanout'
     EXCHANGE_NAME = 'products_update'
+    VIRTUAL_LIST = '--virtual' in sys.argv[1:]
+    PAGE_ROWS = 50 # rows per keyset page
+    PREFETCH_ROWS = 50 # rows loaded beyond the visible ones in each direction
+    MAX_LOADED_ROWS = 500 # loaded rows limit of virtual list, the far end is unloaded
+    CACHE_ROWS = 1000 # product repository LRU size
 
 ######################################################
 ## DB part
@@ -28,9 +48,37 @@ CREATE TABLE IF NOT EXISTS Products (
        id INTEGER PRIMARY KEY,
        name TEXT NOT NULL UNIQUE,
        qty INTEGER DEFAULT 0,
-       last_update TEXT DEFAULT (datetime())
+       last_update TEXT DEFAULT (datetime()),
+       version INTEGER NOT NULL DEFAULT 0 -- ProductsLog version of the last change
+);
+CREATE TABLE IF NOT EXISTS ProductsLog (
+       version INTEGER PRIMARY KEY AUTOINCREMENT, -- monotonic, never reused
+       id INTEGER NOT NULL UNIQUE, -- product id, only its last change is kept
+       deleted INTEGER NOT NULL DEFAULT 0 -- tombstone
 );
 ''')
+if 'version' not in [col[1] for col in cursor.execute('PRAGMA table_info(Products)')]:
+    cursor.execute('ALTER TABLE Products ADD COLUMN version INTEGER NOT NULL DEFAULT 0') # table of older client
+# no conflict clauses inside triggers, they would be overridden by OR IGNORE of the outer statement
+cursor.executescript('''
+CREATE TRIGGER IF NOT EXISTS Products_log_insert AFTER INSERT ON Products
+BEGIN
+    DELETE FROM ProductsLog WHERE id = NEW.id;
+    INSERT INTO ProductsLog (id, deleted) VALUES (NEW.id, 0);
+    UPDATE Products SET version = (SELECT max(version) FROM ProductsLog) WHERE id = NEW.id;
+END;
+CREATE TRIGGER IF NOT EXISTS Products_log_update AFTER UPDATE OF name, qty, last_update ON Products
+BEGIN
+    DELETE FROM ProductsLog WHERE id = NEW.id;
+    INSERT INTO ProductsLog (id, deleted) VALUES (NEW.id, 0);
+    UPDATE Products SET version = (SELECT max(version) FROM ProductsLog) WHERE id = NEW.id;
+END;
+CREATE TRIGGER IF NOT EXISTS Products_log_delete AFTER DELETE ON Products
+BEGIN
+    DELETE FROM ProductsLog WHERE id = OLD.id;
+    INSERT INTO ProductsLog (id, deleted) VALUES (OLD.id, 1);
+END;
+''')
 db.commit()
 
 # #test
@@ -39,55 +87,150 @@ db.commit()
 # r1 = cursor.execute('INSERT OR IGNORE INTO Products (name, qty) VALUES ("name2", 20)')
 # print('affected rowcount: ', r1.rowcount)
 
-class ProductItem:
-    @classmethod
-    def Select(cls, id=None, name=None):
-        global cursor
-        if id:
-            cursor.execute('SELECT id,name,qty,last_update FROM Products WHERE id=? LIMIT 1', (id,))
-        elif name:
-            cursor.execute('SELECT id,name,qty,last_update FROM Products WHERE name=? LIMIT 1', (name,))
-        rows = cursor.fetchall()
-        if len(rows) > 0:
-            cls._row = rows[0]
-            cls.id = cls._row[0]
-            cls.name = cls._row[1]
-            cls.qty = cls._row[2]
-            cls.last_update = cls._row[3]
-        return cls
-
-    @staticmethod
-    def New(name, qty):
-        global cursor, db
-        result = cursor.execute('INSERT OR IGNORE INTO Products (name, qty) VALUES (?,?)', (name, qty))
-        db.commit()
+class ProductRow(namedtuple('ProductRow', ['id', 'name', 'qty', 'last_update'])):
+    '''immutable Products row'''
+    __slots__ = ()
+
+
+class ProductRepository:
+    '''
+    Products access with LRU row cache by id & by name.
+    Cached rows are replaced or evicted precisely by ProductsLog change feed
+    (sync() on products_update notifications), own writes evict their rows.
+    '''
+    SELECT_ROW = 'SELECT id,name,qty,last_update FROM Products'
+
+    def __init__(self, db, capacity=Cfg.CACHE_ROWS):
+        self.db = db
+        self.cursor = db.cursor()
+        self.capacity = capacity
+        self.rows = OrderedDict() # id -> ProductRow, the least recently used first
+        self.ids = {} # name -> id of cached rows
+        self.synced = self.version() # change feed version the cache is valid for
+
+    # cache
+
+    def _unname(self, row):
+        # a stale row may share the name with a newer one until the next sync
+        if self.ids.get(row.name) == row.id:
+            del self.ids[row.name]
+
+    def _put(self, row):
+        old = self.rows.pop(row.id, None)
+        if old is not None:
+            self._unname(old)
+        self.rows[row.id] = row
+        self.ids[row.name] = row.id
+        if len(self.rows) > self.capacity:
+            _, lru = self.rows.popitem(last=False)
+            self._unname(lru)
+
+    def _evict(self, id):
+        old = self.rows.pop(id, None)
+        if old is not None:
+            self._unname(old)
+
+    def _fetch(self, where, params):
+        self.cursor.execute(self.SELECT_ROW + ' WHERE ' + where + ' LIMIT 1', params)
+        r = self.cursor.fetchone()
+        if r is None:
+            return None
+        row = ProductRow(*r)
+        self._put(row)
+        return row
+
+    def get(self, id):
+        '''row by id or None'''
+        row = self.rows.get(id)
+        if row is not None:
+            self.rows.move_to_end(id)
+            return row
+        return self._fetch('id = ?', (id,))
+
+    def get_by_name(self, name):
+        '''row by name or None'''
+        id = self.ids.get(name)
+        if id is not None and self.rows[id].name == name:
+            self.rows.move_to_end(id)
+            return self.rows[id]
+        return self._fetch('name = ?', (name,))
+
+    # writes
+
+    def new(self, name, qty):
+        result = self.cursor.execute('INSERT OR IGNORE INTO Products (name, qty) VALUES (?,?)', (name, qty))
+        self.db.commit()
         return result.rowcount
 
-    @staticmethod
-    def Update(id, last_update, set_name, set_qty):
-        global cursor, db
-        result = cursor.execute('''
+    def update(self, id, last_update, set_name, set_qty):
+        result = self.cursor.execute('''
             UPDATE OR IGNORE Products SET
                 name = :name,
                 qty = :qty,
                 last_update = datetime()
             WHERE id = :id AND last_update = :upd_time
         ''', {'name': set_name, 'qty': set_qty, 'id': id, 'upd_time': last_update})
-        db.commit()
+        self.db.commit()
+        self._evict(id)
         return result.rowcount
 
-    @staticmethod
-    def Delete(id, last_update):
-        global cursor, db
-        result = cursor.execute('DELETE FROM Products WHERE id = ? AND last_update = ?', (id, last_update))
-        db.commit()
+    def delete(self, id, last_update):
+        result = self.cursor.execute('DELETE FROM Products WHERE id = ? AND last_update = ?', (id, last_update))
+        self.db.commit()
+        self._evict(id)
         return result.rowcount
 
-
-# print('affected rowcount: ', ProductItem.New('name3', 30))
-# print('ProductItem.Select(1):', ProductItem.Select(1).__dict__)
-# print('affected rowcount: ', ProductItem.Update(1, ProductItem.Select(1).last_update, 'name 1', 30))
-# print('affected rowcount: ', ProductItem.Delete(1, ProductItem.Select(1).last_update))
+    # lists (not cached)
+
+    def all(self):
+        '''all rows ordered by name'''
+        self.cursor.execute(self.SELECT_ROW + ' ORDER BY name')
+        return [ProductRow(*r) for r in self.cursor.fetchall()]
+
+    def page(self, after=None, before=None, limit=Cfg.PAGE_ROWS, inclusive=False):
+        '''
+        keyset page of rows ordered by (name, id)
+        after/before is (name, id) key, rows go from it forward/backward (but are returned ascending)
+        '''
+        op = '=' if inclusive else ''
+        if before:
+            self.cursor.execute(self.SELECT_ROW + ''' WHERE (name, id) <%s (?, ?)
+                ORDER BY name DESC, id DESC LIMIT ?''' % op, (*before, limit))
+            return [ProductRow(*r) for r in self.cursor.fetchall()[::-1]]
+        if after:
+            self.cursor.execute(self.SELECT_ROW + ''' WHERE (name, id) >%s (?, ?)
+                ORDER BY name, id LIMIT ?''' % op, (*after, limit))
+        else:
+            self.cursor.execute(self.SELECT_ROW + ' ORDER BY name, id LIMIT ?', (limit,))
+        return [ProductRow(*r) for r in self.cursor.fetchall()]
+
+    # change feed
+
+    def version(self):
+        '''current version of the catalog'''
+        self.cursor.execute('SELECT coalesce(max(version), 0) FROM ProductsLog')
+        return self.cursor.fetchone()[0]
+
+    def sync(self):
+        '''
+        changes after synced version ordered by version [(version, id, row),],
+        row is ProductRow or None for deleted product; cached rows are refreshed
+        '''
+        self.cursor.execute('''
+            SELECT l.version, l.id, l.deleted, p.id, p.name, p.qty, p.last_update
+            FROM ProductsLog l LEFT JOIN Products p ON p.id = l.id
+            WHERE l.version > ? ORDER BY l.version
+        ''', (self.synced,))
+        changes = [(r[0], r[1], None if r[2] or r[3] is None else ProductRow(*r[3:])) for r in self.cursor.fetchall()]
+        for _, id, row in changes:
+            if id in self.rows:
+                if row is None:
+                    self._evict(id)
+                else:
+                    self._put(row)
+        if changes:
+            self.synced = changes[-1][0]
+        return changes
 
 
 ######################################################
@@ -100,12 +243,14 @@ class ProductFrame(tk.Frame):
 
     def __init__(self, *args, **kwargs):
         '''init frame'''
-        self.queue = kwargs.pop('queue', None)
+        self.repo = kwargs.pop('repo')
         self.notify_update = kwargs.pop('notify_update', None)
+        self.virtual = kwargs.pop('virtual', False)
 
         tk.Frame.__init__(self, *args, **kwargs)
 
-        self.treeview = ttk.Treeview(self, height=6)
+        self.list_frame = ttk.Frame(self)
+        self.treeview = ttk.Treeview(self.list_frame, height=6)
         self.treeview['columns'] = ['id', 'name', 'qty', 'last_update']
         self.treeview['show'] = 'headings'
         self.treeview.heading('id', text='ID')
@@ -117,7 +262,17 @@ class ProductFrame(tk.Frame):
         self.treeview.column('qty', minwidth=0, width=100, stretch=tk.NO, anchor=tk.CENTER)
         self.treeview.column('last_update', minwidth=0, width=120, stretch=tk.NO)
 
-        self.treeview.pack(side=tk.TOP, fill=tk.BOTH, expand=1)
+        self.scrollbar = ttk.Scrollbar(self.list_frame, orient=tk.VERTICAL, command=self.treeview.yview)
+        self.treeview.configure(yscrollcommand=self.onScroll)
+        self.scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.treeview.pack(side=tk.LEFT, fill=tk.BOTH, expand=1)
+        self.list_frame.pack(side=tk.TOP, fill=tk.BOTH, expand=1)
+        self.rows = {} # id -> row shown in treeview
+        self.order = [] # (name, id) of shown rows, sorted as treeview
+        self.at_start = True # loaded rows start from the first product (virtual list)
+        self.at_end = True # loaded rows end with the last product (virtual list)
+        self.paging = False # page in is scheduled
+        self.syncing = False # sync with change feed is scheduled
 
         self.view_buttons = ttk.Frame(self)
         ttk.Button(self.view_buttons, text='New', command=self.onNew).pack(side=tk.LEFT, fill=tk.X, expand=1)
@@ -150,15 +305,72 @@ class ProductFrame(tk.Frame):
 
         self.updateTreeview()
 
-        self.process_inbound()
+    def on_message(self, msg):
+        '''inbound update notification, a burst of them is synced once up to the latest version'''
+        try:
+            version = json.loads(msg)['version']
+        except (ValueError, KeyError, TypeError):
+            version = None # older client ('upd'), version unknown
+        if (version is None or version > self.repo.synced) and not self.syncing:
+            self.syncing = True
+            self.after_idle(self.onSync)
+
+    def onSync(self):
+        self.syncing = False
+        self.syncTreeview()
+
+    def onScroll(self, first, last):
+        '''treeview view changed: update scrollbar, page in rows near the loaded ends'''
+        self.scrollbar.set(first, last)
+        if self.virtual and not self.paging:
+            self.paging = True
+            self.after_idle(self.pageIn)
+
+    def pageIn(self):
+        '''load next/previous page if the view is within prefetch margin of the loaded rows'''
+        self.paging = False
+        if not self.order:
+            return
+        first, last = self.treeview.yview()
+        margin = Cfg.PREFETCH_ROWS / len(self.order)
+        if last >= 1 - margin and not self.at_end:
+            rows = self.repo.page(after=self.order[-1])
+            self.at_end = len(rows) < Cfg.PAGE_ROWS
+            self.loadRows(rows, len(self.order))
+        elif first <= margin and not self.at_start:
+            rows = self.repo.page(before=self.order[0])
+            self.at_start = len(rows) < Cfg.PAGE_ROWS
+            self.loadRows(rows, 0)
+
+    def loadRows(self, rows, index):
+        '''insert page at index (0 or end), unload the far end over MAX_LOADED_ROWS'''
+        top = self.treeview.identify_row(1) # first visible row
+        rows = [row for row in rows if row[0] not in self.rows]
+        for i, row in enumerate(rows):
+            self.treeview.insert('', index + i, str(row[0]), values=row)
+            self.rows[row[0]] = row
+        self.order[index:index] = [(row[1], row[0]) for row in rows]
+
+        excess = len(self.order) - Cfg.MAX_LOADED_ROWS
+        if excess > 0:
+            if index == 0:
+                gone, self.order = self.order[-excess:], self.order[:-excess]
+                self.at_end = False
+            else:
+                gone, self.order = self.order[:excess], self.order[excess:]
+                self.at_start = False
+            self.treeview.delete(*[id for _, id in gone])
+            for _, id in gone:
+                del self.rows[id]
+
+        if top and self.treeview.exists(top):
+            self.treeview.yview_moveto(self.treeview.index(top) / max(1, len(self.order)))
 
-    def process_inbound(self):
-        '''process inbound messages queue'''
-        if not self.queue.empty():
-            with self.queue.mutex:
-                self.queue.queue.clear()
-            self.updateTreeview()
-        self.after(200, self.process_inbound)
+    def inWindow(self, key):
+        '''(name, id) key is within loaded rows (always for not virtual list)'''
+        if not self.order:
+            return self.at_start and self.at_end
+        return (self.at_start or key > self.order[0]) and (self.at_end or key < self.order[-1])
 
     def enableEdit(self, enable, suffix = None):
         for child in self.group.winfo_children():
@@ -183,7 +395,7 @@ class ProductFrame(tk.Frame):
 
     def reportUpdate(self):
         if self.notify_update:
-            self.notify_update()
+            self.notify_update(self.repo.version())
 
     def onNew(self):
         self.onCancel()
@@ -193,30 +405,28 @@ class ProductFrame(tk.Frame):
     def onEdit(self):
         self.onCancel()
         selected = self.treeview.focus()
-        if selected:
-            item = self.treeview.item(selected)
-            vals = item['values']
-            self.item_id = vals[0]
-            self.item_last_update = vals[3]
-            self.var_edit_name.set(vals[1])
-            self.var_edit_qty.set(vals[2])
+        row = self.repo.get(int(selected)) if selected else None
+        if row:
+            self.item_id = row.id
+            self.item_last_update = row.last_update
+            self.var_edit_name.set(row.name)
+            self.var_edit_qty.set(row.qty)
             self.enableEdit(True, 'Edit')
             self.mode = ProductFrame.MODE_EDIT
 
     def onDetele(self):
         self.onCancel()
         selected = self.treeview.focus()
-        if selected:
-            item = self.treeview.item(selected)
-            vals = item['values']
-            rows_affected = ProductItem.Delete(vals[0], vals[3])
+        row = self.repo.get(int(selected)) if selected else None
+        if row:
+            rows_affected = self.repo.delete(row.id, row.last_update)
             if rows_affected > 0:
                 self.clearItem() #ok
                 self.reportUpdate()
             else:
                 self.errorItem('No rows affected! No such item or last_update changed in background!')
 
-        self.updateTreeview()
+        self.syncTreeview()
 
     def onOk(self):
         name = self.var_edit_name.get()
@@ -229,9 +439,9 @@ class ProductFrame(tk.Frame):
         rows_affected = 0
 
         if self.mode == ProductFrame.MODE_NEW:
-            rows_affected = ProductItem.New(name, qty)
+            rows_affected = self.repo.new(name, qty)
         elif self.mode == ProductFrame.MODE_EDIT:
-            rows_affected = ProductItem.Update(self.item_id, self.item_last_update, name, qty)
+            rows_affected = self.repo.update(self.item_id, self.item_last_update, name, qty)
 
         if rows_affected > 0:
             self.clearItem() #ok
@@ -239,57 +449,126 @@ class ProductFrame(tk.Frame):
         else:
             self.errorItem('No rows affected! Name is not unique or last_update changed in background!')
 
-        self.updateTreeview()
+        self.syncTreeview()
 
     def onCancel(self):
         self.clearItem()
 
     def updateTreeview(self):
-        global cursor
-        self.treeview.delete(*self.treeview.get_children())        
-        cursor.execute('SELECT id,name,qty,last_update FROM Products ORDER BY name')
-        rows = cursor.fetchall()
-        index = 0
-        for row in rows:
-            self.treeview.insert("", index, row[0], values=row)
-            index += 1
+        '''
+        sync treeview with Products by minimal delete/item/insert/move calls,
+        rows are keyed by id, selection & scroll position are kept
+        '''
+        self.repo.sync() # cache up to date before reading, later changes are fetched again by sync
+        top = self.treeview.identify_row(1) # first visible row
+        if self.virtual:
+            '''reload visible page & prefetch margins around the first visible row'''
+            anchor = (self.rows[int(top)][1], int(top)) if top else None
+            above = self.repo.page(before=anchor, limit=Cfg.PREFETCH_ROWS) if anchor else []
+            below = self.repo.page(after=anchor, limit=Cfg.PAGE_ROWS + Cfg.PREFETCH_ROWS, inclusive=True)
+            self.at_start = len(above) < Cfg.PREFETCH_ROWS
+            self.at_end = len(below) < Cfg.PAGE_ROWS + Cfg.PREFETCH_ROWS
+            rows = above + below
+        else:
+            rows = self.repo.all()
+
+        '''remove deleted'''
+        ids = set(row[0] for row in rows)
+        gone = [id for id in self.rows if id not in ids]
+        if gone:
+            self.treeview.delete(*gone)
+            for id in gone:
+                del self.rows[id]
+
+        '''update changed, insert new, keep order by name'''
+        children = list(self.treeview.get_children())
+        for index, row in enumerate(rows):
+            id = row[0]
+            iid = str(id)
+            old = self.rows.get(id)
+            if old is None:
+                self.treeview.insert('', index, iid, values=row)
+                children.insert(index, iid)
+            else:
+                if old != row: # last_update changed (or edited within the same second)
+                    self.treeview.item(iid, values=row)
+                if children[index] != iid: # renamed item moves
+                    self.treeview.move(iid, '', index)
+                    children.remove(iid)
+                    children.insert(index, iid)
+            self.rows[id] = row
+        self.order = [(row[1], row[0]) for row in rows]
+
+        '''restore scroll position'''
+        if top and self.treeview.exists(top):
+            self.treeview.yview_moveto(self.treeview.index(top) / max(1, len(children)))
+
+    def syncTreeview(self):
+        '''apply changes after the last synced version only'''
+        changes = self.repo.sync()
+        if not changes:
+            return
+        top = self.treeview.identify_row(1) # first visible row
+
+        for version, id, row in changes:
+            iid = str(id)
+            old = self.rows.get(id)
+            if row is not None and not self.inWindow((row[1], id)):
+                row = None # not loaded part of virtual list
+            if old is not None and (row is None or row[1] != old[1]):
+                '''remove from old position'''
+                index = bisect_left(self.order, (old[1], id))
+                del self.order[index]
+                if row is None:
+                    self.treeview.delete(iid)
+                    del self.rows[id]
+                else:
+                    self.treeview.detach(iid)
+
+            if row is not None and row != old:
+                key = (row[1], id)
+                if old is None:
+                    index = bisect_left(self.order, key)
+                    self.order.insert(index, key)
+                    self.treeview.insert('', index, iid, values=row)
+                else:
+                    self.treeview.item(iid, values=row)
+                    if row[1] != old[1]: # renamed
+                        index = bisect_left(self.order, key)
+                        self.order.insert(index, key)
+                        self.treeview.move(iid, '', index)
+                self.rows[id] = row
+
+        '''restore scroll position'''
+        if top and self.treeview.exists(top):
+            self.treeview.yview_moveto(self.treeview.index(top) / max(1, len(self.order)))
 
 ######################################################
 ## main
 
-# init rabbit parts
-msg_queue = queue.Queue()
-consumer_thread = ConsumerThread(msg_queue, Cfg.AMQP_HOST, Cfg.EXCHANGE_TYPE, Cfg.EXCHANGE_NAME)
-consumer_thread.start()
-producer = Producer(Cfg.AMQP_HOST, Cfg.EXCHANGE_TYPE, Cfg.EXCHANGE_NAME)
-
-
-root = tk.Tk()
-root.title('Products')
-
-ProductFrame(root, 
-    queue = msg_queue,
-    notify_update = lambda: producer.publish('upd')
-    ).pack(fill=tk.BOTH, expand=1)
-
-root.update() # completes any pending geometry 
-root.minsize(root.winfo_width(), root.winfo_height()) # set minimum window size
-
+async def main():
+    # init rabbit parts (one auto-reconnecting connection for consuming & publishing)
+    consumer = AsyncConsumer(Cfg.AMQP_HOST)
+    await consumer.connect()
+    consumer.declare_exchange(Cfg.EXCHANGE_TYPE, Cfg.EXCHANGE_NAME)
 
-def process_data_events():
-    global root, producer
-    producer.process_data_events()
-    root.after(500, process_data_events)
-process_data_events() #producer heartbit
+    root = tk.Tk()
+    root.title('Products')
 
-root.protocol('WM_DELETE_WINDOW', lambda: root.quit())
-tk.mainloop()  # GUI mainloop
+    frame = ProductFrame(root, 
+        repo = ProductRepository(db),
+        virtual = Cfg.VIRTUAL_LIST,
+        notify_update = lambda version: consumer.publish(Cfg.EXCHANGE_NAME, '', json.dumps({'version': version}))
+        )
+    frame.pack(fill=tk.BOTH, expand=1)
+    await consumer.subscribe(Cfg.EXCHANGE_TYPE, Cfg.EXCHANGE_NAME, callback=frame.on_message)
 
-# stop consume
-consumer_thread.stop() # set stop-flag
+    root.update() # completes any pending geometry 
+    root.minsize(root.winfo_width(), root.winfo_height()) # set minimum window size
 
-# cleanup
-producer.close()
-consumer_thread.join() # wait exit
+    await tk_mainloop(root)  # GUI & AMQP messages on one loop
 
+    # cleanup
+    await consumer.close() # sends what is queued
 
+asyncio.run(main())
@@ -0,0 +1,30 @@
+'''
+Tk event processing driven by asyncio loop.
+
+GUI and asyncio AMQP consumer (amqp.async_consumer) share one thread, so
+inbound messages are handled by callbacks as soon as they arrive, without
+consumer threads, queues & polling timers. Tk after() timers keep working.
+
+Tk does not expose its event source (the display connection) to asyncio,
+so Tk events are polled every `interval`: an idle window wakes up 50 times
+a second for a non-blocking update() (microseconds each). Larger interval
+means fewer wakeups but slower response to input, AMQP messages are not
+affected by it.
+'''
+
+import asyncio
+import tkinter as tk
+
+UPDATE_INTERVAL = 0.02 # sec between Tk events processing
+
+async def tk_mainloop(root, interval=UPDATE_INTERVAL):
+    '''process Tk events from asyncio loop until window is closed, then destroy it'''
+    closed = asyncio.Event()
+    root.protocol('WM_DELETE_WINDOW', closed.set)
+    while not closed.is_set():
+        try:
+            root.update()
+        except tk.TclError:
+            return # root destroyed by the app itself
+        await asyncio.sleep(interval)
+    root.destroy()